@@ -1,4 +1,4 @@
-from flask import Flask, render_template, render_template_string, request, redirect, url_for, session, g, abort, flash, send_file, send_from_directory, jsonify
+from flask import Flask, render_template, render_template_string, request, redirect, url_for, session, g, abort, flash, send_file, send_from_directory, jsonify, Response, stream_with_context
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -7,13 +7,19 @@ from markdown2 import markdown
 
 import json
 import os
-from functools import wraps
+from functools import wraps, partial
 import shutil
-
-import re
+import threading
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import lib_ai_utilities as ai
 import lib_video_utilities as video
+import lib_job_utilities as jobs
+import lib_index_utilities as index
+import lib_schema_utilities as schemas
+import lib_metrics_utilities as metrics
 
 # setup
 import tomllib
@@ -34,6 +40,31 @@ google_ai_studio_key = config["Api_keys"]["Gemini"]
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# document analysis: how many gemini calls run at once, max pdf pages per call, merge step before the plan
+extraction_config = config.get("Extraction", {})
+MAP_CONCURRENCY = extraction_config.get("map_concurrency", 4)
+MAP_BATCH_PAGES = extraction_config.get("map_batch_pages", 30)
+CONSOLIDATE_ANALYSIS = extraction_config.get("consolidate", True)
+
+# notes + quizzes of a whole chapter in one model call
+CHAPTER_BATCHING = config.get("Generation", {}).get("batch_chapters", True)
+# quizzes have this many questions, with fewer than QUIZ_MIN_QUESTIONS valid ones we dont save it at all
+QUIZ_QUESTIONS = 10
+QUIZ_MIN_QUESTIONS = config.get("Generation", {}).get("quiz_min_questions", 6)
+
+# subtopic prompts only get the top chunks of the analysis, up to this many tokens
+context_config = config.get("Context", {})
+CONTEXT_TOP_K = context_config.get("top_k", 8)
+CONTEXT_TOKEN_BUDGET = context_config.get("token_budget", 6000)
+
+# /metrics for prometheus, with a token the scraper has to send "Authorization: Bearer <token>"
+metrics_config = config.get("Metrics", {})
+METRICS_ENABLED = metrics_config.get("enabled", True)
+METRICS_TOKEN = metrics_config.get("token", "")
+# `flask --app app worker` has no flask server, it serves its own metrics here
+METRICS_WORKER_HOST = metrics_config.get("worker_host", "127.0.0.1")
+METRICS_WORKER_PORT = metrics_config.get("worker_port", 9101)
+
 # --- Database helper --- #
 DATABASE = "users.db"
 
@@ -57,6 +88,21 @@ def close_connection(exception):
     if db is not None:
         db.close()
 
+@app.before_request
+def start_request_timer():
+    g._request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    start = getattr(g, "_request_start", None)
+    if start is not None:
+        # the route pattern, not the path, otherwise every project id gets its own series.
+        # streamed responses (sse) are measured up to the first byte
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, route=route, method=request.method,
+                                        status=response.status_code)
+    return response
+
 def init_db():
     with app.app_context():
         db = get_db()
@@ -64,6 +110,7 @@ def init_db():
             "CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT)"
         )
         db.commit()
+    jobs.init_jobs_table()
 
 # ===============================================================================
 #                                     Index      
@@ -187,13 +234,14 @@ def create_project():
 @app.route("/projects/<int:project_id>")
 @login_required
 def view_project(project_id):
-    # if we already extracted the information from the uploaded files 
+    # if we already made a learning plan from the uploaded files
+    # (not analysis.txt, that one can exist without a plan when the plan generation failed)
     file_path = os.path.join(
         "uploads",
         f"user_{session['user_id']}",
         f"project_{project_id}",
-        "extracted",
-        "analysis.txt"
+        "content",
+        "plan.json"
     )
 
 
@@ -271,6 +319,148 @@ def upload_file(project_id):
     return redirect(url_for("view_project", project_id=project_id))
 
 
+def _analysis_paths(project_folder):
+    extracted_folder = os.path.join(project_folder, "extracted")
+    return os.path.join(extracted_folder, "docs"), os.path.join(extracted_folder, "analysis.txt")
+
+
+def _index_path(project_folder):
+    return os.path.join(project_folder, "extracted", "index.json")
+
+
+def analyze_document(file_path, pages=None):
+    """
+    Sends one document (or a page range of it) to gemini and returns its analysis (or None if gemini didnt answer).
+    """
+    text_prompt = "Analyze the provided documents and images in the highest detaill possible. Answer in the language that the media is in"
+
+    # Send multimodal request to Gemini (woah the guy who wrote that helper file must be so smart)
+    response = ai.prompt_gemini_multimodal(text_prompt, files=[file_path], pages=pages)
+    if response and "candidates" in response:
+        return response["candidates"][0]["content"]["parts"][0]["text"]
+    return None
+
+
+def rebuild_project_analysis(project_folder, files):
+    """
+    Glues the per-document analyses of the given files together into analysis.txt (no model call).
+    Analyses of documents that arent part of the project anymore get deleted.
+    """
+    docs_folder, analysis_file = _analysis_paths(project_folder)
+    os.makedirs(docs_folder, exist_ok=True)
+
+    sections = []
+    used = set()
+    for file_path in files:
+        doc_hash = ai.file_hash(file_path)
+        doc_analysis = os.path.join(docs_folder, f"{doc_hash}.txt")
+        if not os.path.isfile(doc_analysis):
+            continue
+        used.add(f"{doc_hash}.txt")
+        with open(doc_analysis, "r", encoding="utf-8") as f:
+            sections.append(f"# {os.path.basename(file_path)}\n\n{f.read()}")
+
+    for name in os.listdir(docs_folder):
+        if name not in used:
+            os.remove(os.path.join(docs_folder, name))
+
+    if not sections:
+        if os.path.exists(_index_path(project_folder)):
+            os.remove(_index_path(project_folder))
+        return False
+    analysis = "\n\n".join(sections)
+    with open(analysis_file, "w", encoding="utf-8") as f:
+        f.write(analysis)
+
+    # search index for the subtopic prompts, so they only get the relevant parts of the analysis
+    index.build_index(analysis, _index_path(project_folder))
+    return True
+
+
+def update_project_analysis(project_folder, files):
+    """
+    Analyzes every document whose content (hash) we havent analyzed yet, then rebuilds analysis.txt.
+    So adding one pdf only costs one gemini call instead of re-analyzing the whole project.
+
+    This is the "map" step: big PDFs are cut into page batches and all batches of all new
+    documents run concurrently, so the time stays about the same as the project grows.
+
+    Returns False if any document has no analysis, the plan must not be built from part of the project.
+    """
+    docs_folder, _ = _analysis_paths(project_folder)
+    os.makedirs(docs_folder, exist_ok=True)
+
+    new_docs = {}
+    for file_path in files:
+        doc_analysis = os.path.join(docs_folder, f"{ai.file_hash(file_path)}.txt")
+        if not os.path.isfile(doc_analysis):
+            new_docs[file_path] = doc_analysis
+
+    batches = [(file_path, pages) for file_path in new_docs for pages in ai.pdf_page_batches(file_path, MAP_BATCH_PAGES)]
+    failed = []
+    if batches:
+        print(f"Analyzing {len(new_docs)} new documents in {len(batches)} batches...")
+        with ThreadPoolExecutor(max_workers=MAP_CONCURRENCY) as pool:
+            results = list(pool.map(lambda batch: analyze_document(*batch), batches))
+
+        for file_path, doc_analysis in new_docs.items():
+            texts = [text for (batch_file, _), text in zip(batches, results) if batch_file == file_path]
+            if None in texts:
+                print(f"No analysis for {file_path}, will retry on the next extract")
+                failed.append(file_path)
+                continue
+            with open(doc_analysis, "w", encoding="utf-8") as f:
+                f.write("\n\n".join(texts))
+
+    # the per-document analyses that worked are kept, the next extract only retries the failed ones.
+    # analysis.txt is only written once every document has one
+    if failed:
+        return False
+    return rebuild_project_analysis(project_folder, files)
+
+
+def consolidate_analysis(project_folder, files):
+    """
+    The "reduce" step: merges the per-document/per-batch analyses into one consistent analysis
+    with a single gemini call. Only used as input for the plan, and cached by the content it was made from.
+    """
+    _, analysis_file = _analysis_paths(project_folder)
+    with open(analysis_file, "r", encoding="utf-8") as f:
+        analysis = f.read()
+
+    map_parts = sum(len(ai.pdf_page_batches(f, MAP_BATCH_PAGES)) for f in files)
+    if not CONSOLIDATE_ANALYSIS or map_parts < 2:
+        return analysis
+
+    digest = hashlib.sha256(analysis.encode("utf-8")).hexdigest()
+    consolidated_file = os.path.join(os.path.dirname(analysis_file), f"consolidated_{digest}.txt")
+    if os.path.isfile(consolidated_file):
+        with open(consolidated_file, "r", encoding="utf-8") as f:
+            return f.read()
+
+    prompt = "The following are separate analyses of parts of the same course material. Merge them into one consistent, well structured analysis: remove duplicates, keep every fact, formula and definition, and order the content logically. Answer in the language the analyses are in. Analyses: " + analysis
+    consolidated = ai.prompt_gemini(google_ai_studio_key, prompt)
+    # prompt_gemini returns error strings instead of raising, dont cache those
+    if ai.is_error_response(consolidated):
+        print("Consolidation failed, using the unmerged analysis:", consolidated)
+        return analysis
+
+    # old consolidations are outdated now
+    for name in os.listdir(os.path.dirname(analysis_file)):
+        if name.startswith("consolidated_"):
+            os.remove(os.path.join(os.path.dirname(analysis_file), name))
+    with open(consolidated_file, "w", encoding="utf-8") as f:
+        f.write(consolidated)
+    return consolidated
+
+
+def _project_files(project_id, project_folder):
+    db = get_db()
+    docs = db.execute("SELECT * FROM documents WHERE project_id=?", (project_id,)).fetchall()
+    file_list = [os.path.join(project_folder, doc[1]) for doc in docs]
+    return [f for f in file_list if os.path.exists(f)]
+
+
 @app.route("/projects/<int:project_id>/extract")
 @login_required
 def extract(project_id):
@@ -289,41 +479,16 @@ def extract(project_id):
 
 
 
-    # Get all document records for this project
-    docs = db.execute(
-        "SELECT * FROM documents WHERE project_id=?",
-        (project_id,)
-    ).fetchall()
-
-    # Build absolute file paths for the project’s files
+    # Build absolute file paths for the project’s files (only the ones that exist)
     project_folder = os.path.join(app.config["UPLOAD_FOLDER"], f"user_{user_id}", f"project_{project_id}")
-    file_list = [os.path.join(project_folder, doc[1]) for doc in docs]
-
-    # Only include files that exist
-    existing_files = [f for f in file_list if os.path.exists(f)]
+    existing_files = _project_files(project_id, project_folder)
 
-    text_prompt = "Analyze the provided documents and images in the highest detaill possible. Answer in the language that the media is in"
+    if not existing_files:
+        return "No valid files found to process.", 400
 
-    gemini_text = None
-    if existing_files:
-        # Send multimodal request to Gemini (woah the guy who wrote that helper file must be so smart)
-        response = ai.prompt_gemini_multimodal(text_prompt, files=existing_files)
-
-        if response and "candidates" in response:
-            gemini_text = response["candidates"][0]["content"]["parts"][0]["text"]
-
-            # Create "extracted" folder
-            extracted_folder = os.path.join(project_folder, "extracted")
-            os.makedirs(extracted_folder, exist_ok=True)
-
-            # Save the Ai wisdom to a file
-            output_file = os.path.join(extracted_folder, "analysis.txt")
-            with open(output_file, "w") as f:
-                f.write(gemini_text)
-        else:
-            gemini_text = "No response received from Gemini API. Please check your API key and file paths."
-    else:
-        gemini_text = "No valid files found to process."
+    # only documents we havent seen before go to gemini, the rest comes from extracted/docs/
+    if not update_project_analysis(project_folder, existing_files):
+        return "Not every document could be analyzed by Gemini. Please check your API key and try again.", 502
 
 
     #--------------- make chapters based of of the extracted content ---------------#
@@ -331,15 +496,6 @@ def extract(project_id):
     # am i a prompt engineer or am i a prompt engineer!?
     Prompt = 'You are an AI tutor. I will give you extracted notes from a collection of documents and images. Your job is to design a structured learning plan that teaches everything step by step. Requirements for your output: Return ONLY valid JSON (no explanations, no markdown, no extra text). The JSON must follow this structure: { "chapters": [ { "title": "Chapter Title", "summary": "A short explanation of the key ideas in this chapter, no sentences, max 5 words.", "subtopics": [ { "title": "Subtopic 1 Title", "description": "A brief explanation of the subtopic, max 5 words" }, { "title": "Subtopic 2 Title", "description": "A brief explanation of the subtopic, max 5 words" }, { "title": "Subtopic 3 Title", "description": "A brief explanation of the subtopic, max 5 words" } ] } ] } Guidelines: Break the material into 3–6 logical chapters. Each chapter should cover a coherent theme or concept. Each chapter must contain exactly 3 subtopics, with titles and brief descriptions. Titles should be short (2 words max), clear, and student-friendly. Summaries should be clear enough that a beginner can understand the flow. Answer in the language the analysis is in. Here is the extracted analysis to structure into chapters: <<<ANALYSIS>>>'
     
-    # find the file (hopefully.... please work this time)
-    file_path = os.path.join(
-        "uploads",
-        f"user_{session['user_id']}",
-        f"project_{project_id}",
-        "extracted",
-        "analysis.txt"
-    )
-
     content_folder = os.path.join(
         app.config["UPLOAD_FOLDER"],
         f"user_{user_id}",
@@ -351,38 +507,26 @@ def extract(project_id):
     if os.path.isfile(os.path.join(content_folder, "plan.json")):
         return redirect(url_for('view_project', project_id=project_id))
 
-    with open(file_path, 'r') as file:
-        # Read the entire content of the file into a string
-        content = file.read()
+    # merged analysis of all documents (hopefully.... please work this time)
+    content = consolidate_analysis(project_folder, existing_files)
 
     # append the file to our prompt
     Prompt += content
 
-    Answer =  ai.prompt_gemini(google_ai_studio_key, Prompt)
-
-    print(Answer)
+    # gemini gets the plan schema, the answer is checked against it and asked again if its broken
+    try:
+        plan_data = ai.prompt_gemini_json(google_ai_studio_key, Prompt, schemas.PLAN_SCHEMA)
+    except ai.ModelOutputError as e:
+        print("Failed to get a learning plan from Gemini:", e)
+        return f"Could not generate a valid learning plan, please try again: {e}", 502
 
     os.makedirs(content_folder, exist_ok=True)
 
     plan_file = os.path.join(content_folder, "plan.json")
 
-    clean_answer = Answer.strip()
-    clean_answer = re.sub(r"^```json\s*", "", clean_answer)
-    clean_answer = re.sub(r"```$", "", clean_answer)
-
-    try:
-        plan_data = json.loads(clean_answer)
-    except json.JSONDecodeError as e:
-        print("Failed to parse cleaned Gemini output:", clean_answer)
-        return f"Failed to parse JSON from Gemini: {e}", 500
-
     with open(plan_file, "w") as f:
         json.dump(plan_data, f, indent=2)  # Save properly as plan.json
 
-    # Render the learning site
-    with open(plan_file, "r") as f:
-        plan_data = json.load(f)
-
     return redirect(url_for('view_project', project_id=project_id))
 
 
@@ -502,6 +646,13 @@ def delete_file(file_id):
     db.execute("DELETE FROM documents WHERE id=?", (file_id,))
     db.commit()
 
+    # drop this document from the combined analysis, the other ones stay as they are
+    project_folder = os.path.join(app.config["UPLOAD_FOLDER"], f"user_{user_id}", f"project_{doc[1]}")
+    docs_folder, analysis_file = _analysis_paths(project_folder)
+    if os.path.isdir(docs_folder):
+        if not rebuild_project_analysis(project_folder, _project_files(doc[1], project_folder)) and os.path.exists(analysis_file):
+            os.remove(analysis_file)
+
     flash("File deleted successfully!")
     return redirect(url_for("view_project", project_id=doc[1]))
 
@@ -604,53 +755,45 @@ def view_quiz(filepath):
 #                             Content creation
 #=================================================================================
 
-def extract_json(text: str) -> str:
-    # Look for ```json ... ``` or plain ``` ... ```
-    match = re.search(r"```(?:json)?\s*(.*?)\s*```", text, re.DOTALL)
-    if match:
-        cleaned = match.group(1).strip()
-        print("Removed JSON fences, cleaned output:\n", cleaned)
-        return cleaned
-
-    # No fences detected → just return the text trimmed
-    print("No fences detected, returning as-is.")
-    return text.strip()
+def subtopic_context(user_id, project_id, title, description):
+    """
+    Returns the slice of the project analysis that matters for a subtopic (top chunks of the
+    BM25 index within the token budget). Projects extracted before the index existed get one built here.
+    """
+    project_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"user_{user_id}", f"project_{project_id}")
+    _, analysis_file = _analysis_paths(project_folder)
+    index_file = _index_path(project_folder)
+
+    if os.path.isfile(index_file):
+        project_index = index.load_index(index_file)
+    elif os.path.isfile(analysis_file):
+        with open(analysis_file, "r", encoding="utf-8") as f:
+            project_index = index.build_index(f.read(), index_file)
+    else:
+        return ""
+    return index.select_context(project_index, f"{title} {description}",
+                                top_k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET)
 
 
 # ---------- Bro im the author of clean code at this point, look at this elite ball knowledge, using functions to reuse similar code ----------
 def create_video_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description):
     uploads_root = app.config['UPLOAD_FOLDER']
-    # Read analysis or something (please work this time)
-    analysis_path = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "extracted", "analysis.txt")
-    analysis_text = ""
-    if os.path.isfile(analysis_path):
-        with open(analysis_path, "r", encoding="utf-8") as f:
-            analysis_text = f.read()
+    # only the parts of the analysis that are about this subtopic (please work this time)
+    analysis_text = subtopic_context(user_id, project_id, title, description)
 
     videos_folder = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "videos")
     os.makedirs(videos_folder, exist_ok=True)
     output_abs = os.path.join(videos_folder, f"{chapter_idx}_{sub_idx}.mp4")
 
-    video.make_video(title, description, analysis_text, output_abs)
+    # script + tts are background work, notes/quizzes somebody is waiting for go first
+    with ai.priority(ai.BACKGROUND):
+        video.make_video(title, description, analysis_text, output_abs)
 
     video_relpath = f"uploads/user_{user_id}/project_{project_id}/videos/{chapter_idx}_{sub_idx}.mp4"
     return url_for('view_file', filepath=video_relpath)
 
-def create_notes_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description):
-    uploads_root = app.config['UPLOAD_FOLDER']
-    analysis_path = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "extracted", "analysis.txt")
-    analysis_text = ""
-    if os.path.isfile(analysis_path):
-        with open(analysis_path, "r", encoding="utf-8") as f:
-            analysis_text = f.read()
-
-    notes_folder = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "notes")
-    os.makedirs(notes_folder, exist_ok=True)
-    output_abs = os.path.join(notes_folder, f"{chapter_idx}_{sub_idx}.md")
-
-    # this will (mathematically) absoultely fail bc gemini fucks it up sometimes but empirically it works about 20% of the time
-    # Update wow i should totally pack this in a 5x loop bc 5x20% is 100%, don’t forget to fix this tomorrow...
-    prompt = f"""
+def notes_prompt(title, analysis_text):
+    return f"""
                 Create a concise study cheat sheet in Markdown for the subtopic:
                 "{title}"
 
@@ -689,28 +832,51 @@ def create_notes_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title,
                 - Use proper Markdown headings (#, ##) exactly as shown.
                 - Output ONLY valid Markdown (no extra commentary).
             """
-    notes_response = ai.prompt_gemini(google_ai_studio_key, prompt)
-    # write response (you already have extract_json for JSON dummy; not needed for md)
-    with open(output_abs, "w", encoding="utf-8") as f:
-        f.write(notes_response if isinstance(notes_response, str) else str(notes_response))
 
-    notes_relpath = f"user_{user_id}/project_{project_id}/notes/{chapter_idx}_{sub_idx}.md"
-    return url_for('view_markdown', filepath=notes_relpath)
 
-def create_quiz_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description):
+def generate_notes(title, analysis_text):
+    """
+    Returns checked notes markdown for a subtopic, raises ai.ModelOutputError after [Generation] max_attempts bad answers.
+    """
+    prompt = notes_prompt(title, analysis_text)
+    last_error = None
+    for attempt in range(ai.GENERATION_ATTEMPTS):
+        # the first answer may be cached, if that one was bad we need a fresh one
+        response = ai.prompt_gemini(google_ai_studio_key, prompt, use_cache=attempt == 0)
+        if ai.is_error_response(response):
+            last_error = response
+            continue
+        notes = schemas.repair_notes(response, title)
+        if notes is not None:
+            # a retry worked, remember it under the plain prompt so the next call is free (and not the broken one again)
+            if attempt > 0:
+                ai.response_cache_put(ai.response_cache_key("gemini", ai.GEMINI_MODEL, prompt), notes)
+            return notes
+        last_error = f"not the requested markdown: {response[:200]}"
+        print(f"Notes attempt {attempt + 1} for '{title}' invalid")
+    raise ai.ModelOutputError(f"No valid notes for '{title}': {last_error}")
+
+
+def create_notes_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description):
     uploads_root = app.config['UPLOAD_FOLDER']
-    analysis_path = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "extracted", "analysis.txt")
-    analysis_text = ""
-    if os.path.isfile(analysis_path):
-        with open(analysis_path, "r", encoding="utf-8") as f:
-            analysis_text = f.read()
+    analysis_text = subtopic_context(user_id, project_id, title, description)
 
-    quizzes_folder = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "quizzes")
-    os.makedirs(quizzes_folder, exist_ok=True)
-    output_abs = os.path.join(quizzes_folder, f"{chapter_idx}_{sub_idx}.json")
+    notes_folder = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "notes")
+    os.makedirs(notes_folder, exist_ok=True)
+    output_abs = os.path.join(notes_folder, f"{chapter_idx}_{sub_idx}.md")
+
+    # this will (mathematically) absoultely fail bc gemini fucks it up sometimes but empirically it works about 20% of the time
+    # Update: it is a loop now, only a checked answer gets written (never an error message)
+    notes = generate_notes(title, analysis_text)
+    with open(output_abs, "w", encoding="utf-8") as f:
+        f.write(notes)
 
+    notes_relpath = f"user_{user_id}/project_{project_id}/notes/{chapter_idx}_{sub_idx}.md"
+    return url_for('view_markdown', filepath=notes_relpath)
+
+def quiz_prompt(title, analysis_text, count, avoid=()):
     prompt = f"""
-    Create a 10-question multiple-choice quiz in valid JSON for the subtopic:
+    Create a {count}-question multiple-choice quiz in valid JSON for the subtopic:
     "{title}"
 
     Use the following analysis as background:
@@ -723,17 +889,51 @@ def create_quiz_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, d
     - "options": array of exactly 4 strings
     - "answer": string (must match one of the options)
     """
-    resp = ai.prompt_gemini(google_ai_studio_key, prompt)
-    cleaned = extract_json(resp)
-    try:
-        quiz_data = json.loads(cleaned)
-    except Exception as e:
-        # fallback: try to save raw as error for debugging
-        raise RuntimeError(f"Invalid JSON from model: {e}\nRaw response start: {cleaned[:300]}")
+    if avoid:
+        prompt += "\n    Do not repeat these questions:\n" + "\n".join(f"    - {q}" for q in avoid)
+    return prompt
 
-    # normalize ig
-    if "quiz" in quiz_data and "questions" not in quiz_data:
-        quiz_data = {"questions": quiz_data["quiz"]}
+
+def generate_quiz(title, analysis_text):
+    """
+    Returns a checked quiz ({"questions": [...]}) for a subtopic.
+    Broken questions get repaired or dropped, and only the missing ones are asked for again.
+    Raises ai.ModelOutputError if we end up with fewer than QUIZ_MIN_QUESTIONS.
+    """
+    def repair(data):
+        return schemas.repair_quiz(data)[0]
+
+    questions = []
+    last_error = None
+    for attempt in range(ai.GENERATION_ATTEMPTS):
+        missing = QUIZ_QUESTIONS - len(questions)
+        if missing <= 0:
+            break
+        prompt = quiz_prompt(title, analysis_text, missing, avoid=[q["question"] for q in questions])
+        try:
+            # a retry with the same prompt (nothing valid yet) has to reach the model, not the cache
+            quiz_data = ai.prompt_gemini_json(google_ai_studio_key, prompt, schemas.QUIZ_SCHEMA, repair=repair, attempts=1,
+                                              use_cache=attempt == 0)
+        except ai.ModelOutputError as e:
+            last_error = e
+            continue
+        seen = {q["question"] for q in questions}
+        questions += [q for q in quiz_data["questions"] if q["question"] not in seen][:missing]
+
+    if len(questions) < QUIZ_MIN_QUESTIONS:
+        raise ai.ModelOutputError(f"Only {len(questions)} valid quiz questions for '{title}': {last_error}")
+    return {"questions": questions}
+
+
+def create_quiz_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description):
+    uploads_root = app.config['UPLOAD_FOLDER']
+    analysis_text = subtopic_context(user_id, project_id, title, description)
+
+    quizzes_folder = os.path.join(uploads_root, f"user_{user_id}", f"project_{project_id}", "quizzes")
+    os.makedirs(quizzes_folder, exist_ok=True)
+    output_abs = os.path.join(quizzes_folder, f"{chapter_idx}_{sub_idx}.json")
+
+    quiz_data = generate_quiz(title, analysis_text)
 
     with open(output_abs, "w", encoding="utf-8") as f:
         json.dump(quiz_data, f, ensure_ascii=False, indent=2)
@@ -742,6 +942,199 @@ def create_quiz_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, d
     return url_for('view_quiz', filepath=quiz_relpath)
 
 
+# ---------- chapter batching: notes + quizzes for all subtopics of a chapter in one gemini call ----------
+_chapter_locks = {}
+_chapter_locks_lock = threading.Lock()
+
+
+def _chapter_lock(user_id, project_id, chapter_idx):
+    with _chapter_locks_lock:
+        return _chapter_locks.setdefault((str(user_id), str(project_id), str(chapter_idx)), threading.Lock())
+
+
+
+
+def create_chapter_resources(user_id, project_id, chapter_idx):
+    """
+    Generates the notes and quizzes of every subtopic in a chapter with a single gemini call
+    (instead of 6 calls that all send the same analysis). Items that come back broken are
+    generated again one by one with the normal per-subtopic helpers.
+
+    Returns:
+        dict: (sub_idx, "notes"/"quiz") -> the exception for every item that could not be generated.
+    """
+    project_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"user_{user_id}", f"project_{project_id}")
+    with open(os.path.join(project_folder, "content", "plan.json"), "r") as f:
+        chapter = json.load(f)["chapters"][int(chapter_idx)]
+    subtopics = chapter["subtopics"]
+
+    notes_folder = os.path.join(project_folder, "notes")
+    quizzes_folder = os.path.join(project_folder, "quizzes")
+    os.makedirs(notes_folder, exist_ok=True)
+    os.makedirs(quizzes_folder, exist_ok=True)
+
+    def paths(sub_idx):
+        return (os.path.join(notes_folder, f"{chapter_idx}_{sub_idx}.md"),
+                os.path.join(quizzes_folder, f"{chapter_idx}_{sub_idx}.json"))
+
+    missing = [sub_idx for sub_idx in range(len(subtopics)) if not all(os.path.isfile(p) for p in paths(sub_idx))]
+    if not missing:
+        return {}
+
+    analysis_text = subtopic_context(user_id, project_id, chapter["title"],
+                                     " ".join(f"{sub['title']} {sub['description']}" for sub in subtopics))
+    subtopic_list = "\n".join(f'{i}: "{subtopics[i]["title"]}" ({subtopics[i]["description"]})' for i in missing)
+
+    prompt = f"""
+    Create study material for these subtopics of the chapter "{chapter["title"]}":
+    {subtopic_list}
+
+    Use the following analysis as background:
+    {analysis_text}
+
+    For EVERY subtopic create:
+    - "notes": a concise study cheat sheet in Markdown, starting with "# <subtopic title>", then a short 1–2 sentence overview,
+      then the sections "## 💡 Key Concepts", "## 🏷️ Important Terms" (- **Term**: Short definition) and "## ⚡ Quick Facts",
+      each with 3 bullet points and separated by "---". Keep language clear and beginner-friendly.
+    - "quiz": a 10-question multiple-choice quiz: {{"questions": [{{"question": string, "options": array of exactly 4 strings, "answer": string (must match one of the options)}}]}}
+
+    Rules:
+    - Output ONLY valid JSON, no extra commentary.
+    - Use exactly this structure: {{"subtopics": [{{"index": <number from the list above>, "notes": "<markdown>", "quiz": {{"questions": [...]}}}}]}}
+    - Answer in the language the analysis is in.
+    """
+    resp = ai.prompt_gemini(google_ai_studio_key, prompt, response_schema=schemas.CHAPTER_SCHEMA)
+
+    # no retry for the whole batch, every item is checked on its own below
+    items = {}
+    try:
+        data = schemas.parse_json(resp)
+        for item in data.get("subtopics", []):
+            if isinstance(item, dict):
+                items[str(item.get("index"))] = item
+    except (ValueError, AttributeError) as e:
+        print(f"Chapter batch for chapter {chapter_idx} returned invalid JSON: {e}")
+
+    # one broken subtopic shouldnt stop the others, the errors go back to whoever asked for that item
+    errors = {}
+    for sub_idx in missing:
+        sub = subtopics[sub_idx]
+        notes_path, quiz_path = paths(sub_idx)
+        item = items.get(str(sub_idx), {})
+
+        notes = schemas.repair_notes(item.get("notes"), sub["title"])
+        quiz_data, _ = schemas.repair_quiz(item.get("quiz"))
+
+        # only the broken ones get their own call
+        if not os.path.isfile(notes_path):
+            try:
+                if notes is not None:
+                    with open(notes_path, "w", encoding="utf-8") as f:
+                        f.write(notes)
+                else:
+                    print(f"Batched notes for {chapter_idx}_{sub_idx} invalid, generating them alone")
+                    create_notes_for_subtopic(user_id, project_id, chapter_idx, sub_idx, sub["title"], sub["description"])
+            except Exception as e:
+                print(f"Generating notes {chapter_idx}_{sub_idx} failed: {e}")
+                errors[(sub_idx, "notes")] = e
+        if not os.path.isfile(quiz_path):
+            try:
+                if len(quiz_data["questions"]) >= QUIZ_MIN_QUESTIONS:
+                    with open(quiz_path, "w", encoding="utf-8") as f:
+                        json.dump(quiz_data, f, ensure_ascii=False, indent=2)
+                else:
+                    print(f"Batched quiz for {chapter_idx}_{sub_idx} invalid, generating it alone")
+                    create_quiz_for_subtopic(user_id, project_id, chapter_idx, sub_idx, sub["title"], sub["description"])
+            except Exception as e:
+                print(f"Generating quiz {chapter_idx}_{sub_idx} failed: {e}")
+                errors[(sub_idx, "quiz")] = e
+    return errors
+
+
+def create_subtopic_resource(typ, user_id, project_id, chapter_idx, sub_idx, title, description):
+    """
+    Job handler for notes/quizzes. With chapter batching on, the first click in a chapter generates
+    the whole chapter, so the other subtopics are already there when they get clicked.
+    """
+    create_single = create_notes_for_subtopic if typ == "notes" else create_quiz_for_subtopic
+    if not CHAPTER_BATCHING:
+        with ai.priority(ai.INTERACTIVE):
+            return create_single(user_id, project_id, chapter_idx, sub_idx, title, description)
+
+    _, notes_relpath, quiz_relpath = _resource_relpaths(user_id, project_id, chapter_idx, sub_idx)
+    relpath = notes_relpath if typ == "notes" else quiz_relpath
+    abs_path = os.path.join(app.config['UPLOAD_FOLDER'], relpath)
+
+    # one batch per chapter at a time, the second click just waits for the first one
+    errors = {}
+    with _chapter_lock(user_id, project_id, chapter_idx):
+        if not os.path.isfile(abs_path):
+            with ai.priority(ai.INTERACTIVE):
+                errors = create_chapter_resources(user_id, project_id, chapter_idx)
+
+    if not os.path.isfile(abs_path):
+        # the real reason (e.g. ModelOutputError) ends up in the job's error field
+        error = errors.get((int(sub_idx), typ))
+        if error is not None:
+            raise error
+        raise RuntimeError(f"Could not generate {typ} for subtopic {chapter_idx}_{sub_idx}")
+    return url_for('view_markdown' if typ == "notes" else 'view_quiz', filepath=relpath)
+
+
+@app.route("/api/projects/<int:project_id>/notes/stream")
+@login_required
+def api_notes_stream(project_id):
+    """
+    Streams the notes for a subtopic while gemini writes them (Server-Sent Events).
+    Query params: chapter_idx, sub_idx, title, description
+    Events: default = {"html": markdown so far rendered to html}, "done" = {"url": ...}, "failed" = {"error": ...}
+    """
+    db = get_db()
+    user_id = str(session["user_id"])
+    project = db.execute("SELECT * FROM projects WHERE id=? AND user_id=?", (project_id, user_id)).fetchone()
+    if not project:
+        return jsonify({"error": "forbidden"}), 403
+
+    chapter_idx = request.args.get("chapter_idx")
+    sub_idx = request.args.get("sub_idx")
+    title = request.args.get("title", "")
+    description = request.args.get("description", "")
+    if chapter_idx is None or sub_idx is None:
+        return jsonify({"error": "missing indices"}), 400
+
+    _, notes_relpath, _ = _resource_relpaths(user_id, project_id, chapter_idx, sub_idx)
+    output_abs = os.path.join(app.config['UPLOAD_FOLDER'], notes_relpath)
+    prompt = notes_prompt(title, subtopic_context(user_id, project_id, title, description))
+
+    def event(data, name=None):
+        prefix = f"event: {name}\n" if name else ""
+        return f"{prefix}data: {json.dumps(data)}\n\n"
+
+    def generate():
+        md_text = ""
+        try:
+            with ai.priority(ai.INTERACTIVE):
+                for chunk in ai.prompt_gemini_stream(google_ai_studio_key, prompt):
+                    md_text += chunk
+                    yield event({"html": markdown(md_text, extras=["fenced-code-blocks", "tables"])})
+        except Exception as e:
+            yield event({"error": str(e)}, "failed")
+            return
+
+        # same check as the other notes paths, so broken answers never end up as notes
+        notes = schemas.repair_notes(md_text, title)
+        if notes is None:
+            yield event({"error": "Model returned invalid notes"}, "failed")
+            return
+        os.makedirs(os.path.dirname(output_abs), exist_ok=True)
+        with open(output_abs, "w", encoding="utf-8") as f:
+            f.write(notes)
+        yield event({"url": url_for('view_markdown', filepath=notes_relpath)}, "done")
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route("/projects/<int:project_id>/make_video", methods=["POST"])
 @login_required
 def make_subtopic_video(project_id):
@@ -756,9 +1149,10 @@ def make_subtopic_video(project_id):
     title       = request.form.get("title")
     description = request.form.get("description")
 
-    # call helper (this may take some time Update: actually this may take a lot of time)
-    create_video_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description)
-    flash("Video created successfully!", "success")
+    # this takes ages so it goes into the job queue instead of blocking the request
+    jobs.submit("video", user_id, user_id=user_id, project_id=project_id, chapter_idx=chapter_idx,
+                sub_idx=sub_idx, title=title, description=description)
+    flash("Video queued, it will show up once it is rendered!", "success")
     return redirect(url_for("view_project", project_id=project_id))
 
 
@@ -776,8 +1170,9 @@ def make_subtopic_notes(project_id):
     title       = request.form["title"]
     description = request.form["description"]
 
-    create_notes_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, description)
-    flash("Notes created successfully!", "success")
+    jobs.submit("notes", user_id, user_id=user_id, project_id=project_id, chapter_idx=chapter_idx,
+                sub_idx=sub_idx, title=title, description=description)
+    flash("Notes queued!", "success")
     return redirect(url_for("view_project", project_id=project_id))
 
 
@@ -794,8 +1189,9 @@ def make_subtopic_quiz(project_id):
     sub_idx     = request.form["sub_idx"]
     title       = request.form["title"]
 
-    create_quiz_for_subtopic(user_id, project_id, chapter_idx, sub_idx, title, "")
-    flash("Quiz created successfully!", "success")
+    jobs.submit("quiz", user_id, user_id=user_id, project_id=project_id, chapter_idx=chapter_idx,
+                sub_idx=sub_idx, title=title, description="")
+    flash("Quiz queued!", "success")
     return redirect(url_for("view_project", project_id=project_id))
 
 
@@ -823,18 +1219,14 @@ def api_resource_create(project_id):
     if not project:
         return jsonify({"error": "forbidden"}), 403
 
-    try:
-        if typ == "video":
-            url = create_video_for_subtopic(user_id, project_id, str(chapter_idx), str(sub_idx), title, description)
-        elif typ == "notes":
-            url = create_notes_for_subtopic(user_id, project_id, str(chapter_idx), str(sub_idx), title, description)
-        else:  # quiz
-            url = create_quiz_for_subtopic(user_id, project_id, str(chapter_idx), str(sub_idx), title, description)
-
-        return jsonify({"ok": True, "url": url})
-    except Exception as e:
-        # return message for debugging; in production log and send friendly error
-        return jsonify({"error": str(e)}), 500
+    # the actual generation runs on the job workers, we only hand back a handle to poll
+    job_id = jobs.submit(typ, user_id, user_id=user_id, project_id=project_id, chapter_idx=str(chapter_idx),
+                         sub_idx=str(sub_idx), title=title, description=description)
+    return jsonify({
+        "ok": True,
+        "job_id": job_id,
+        "status_url": url_for("api_job_status", job_id=job_id)
+    }), 202
 
 
 #==================================================================================
@@ -896,11 +1288,84 @@ def api_resource_status(project_id):
     return jsonify({"exists": bool(exists), "url": url})
 
 
+@app.route("/api/jobs/<int:job_id>")
+@login_required
+def api_job_status(job_id):
+    """
+    Returns JSON: {id, type, status: queued|running|done|failed, created_at, started_at, finished_at, url, error}
+    """
+    job = jobs.get_job(job_id)
+    if not job or str(job["user_id"]) != str(session["user_id"]):
+        return jsonify({"error": "not found"}), 404
+
+    return jsonify({
+        "id": job["id"],
+        "type": job["kind"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "url": job["result_url"],
+        "error": job["error"]
+    })
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    if not metrics.authorized(request.headers.get("Authorization"), METRICS_TOKEN):
+        abort(401)
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+#==================================================================================
+#                                 Background jobs
+#==================================================================================
+
+# the helpers call url_for, so every job runs inside a fake request context
+jobs.register("video", create_video_for_subtopic, queue="video")
+jobs.register("notes", partial(create_subtopic_resource, "notes"))
+jobs.register("quiz", partial(create_subtopic_resource, "quiz"))
+
+jobs_config = config.get("Jobs", {})
+
+
+def start_background_workers():
+    """
+    Starts the job workers (and the whisper prewarm) in this process. Only called from the entry
+    points below, importing app (spawned render/pdf pools do that) must not start anything.
+    """
+    jobs.start(
+        {
+            "default": jobs_config.get("default_workers", 4),
+            "video": jobs_config.get("video_workers", 2)
+        },
+        context=app.test_request_context
+    )
+
+    # load whisper in the background so the first video doesnt have to wait for it
+    if config.get("Video", {}).get("whisper_prewarm", False):
+        threading.Thread(target=video.prewarm_whisper, name="whisper-prewarm", daemon=True).start()
+
+
+# workers without the web server: `flask --app app worker` (e.g. next to gunicorn)
+@app.cli.command("worker")
+def run_worker():
+    init_db()
+    # the jobs (model calls, tts, encoding) run here, so do most of the metrics
+    if METRICS_ENABLED and METRICS_WORKER_PORT:
+        metrics.serve(METRICS_WORKER_HOST, METRICS_WORKER_PORT, METRICS_TOKEN)
+    start_background_workers()
+    threading.Event().wait()
 
 
 # --- Main ---
 if __name__ == "__main__":
     init_db()
+    # debug mode runs this file twice (the reloader and the actual server), only the server gets workers
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_workers()
     app.run(debug=True)
 
 
@@ -0,0 +1,312 @@
+# End-to-end benchmarks for the extract and video pipelines, offline against emulator.py.
+# Every stage (pdf render, base64, model calls, tts, audio concat, whisper, subtitles, compositing, encode, ...)
+# gets its wall time, cpu time and peak rss recorded, results are written as json and can be compared to a baseline.
+#
+#   python benchmark.py                       # run everything, write bench/results.json
+#   python benchmark.py --save-baseline       # ... and store it as bench/baseline.json
+#   python benchmark.py --pipelines video --repeat 3 --compare bench/baseline.json
+#
+# run it from the repo root (the libs read config.toml from the cwd). exits with 1 if a stage regressed.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+import fitz
+import imageio_ffmpeg
+from aiohttp import web
+
+import emulator
+import lib_ai_utilities as ai
+import lib_encode_utilities as encode
+import lib_perf_utilities as perf
+import lib_schema_utilities as schemas
+import lib_video_utilities as video
+
+FIXTURE_DIR = os.path.join("bench", "fixtures")
+ANALYSIS_PROMPT = "Analyze the provided documents and images in the highest detaill possible. Answer in the language that the media is in"
+PLAN_PROMPT = 'You are an AI tutor. Design a structured learning plan ("chapters" with "subtopics") for this analysis: '
+
+
+#----------------------- Fixtures -----------------------#
+def make_fixture_pdf(path, pages):
+    """
+    A course script with text pages and every 4th page a scanned (image only) page,
+    so both the text layer and the render path get used.
+    """
+    doc = fitz.open()
+    paragraph = ("Die Photosynthese wandelt Lichtenergie in chemische Energie um. In den Chloroplasten wird Wasser "
+                 "gespalten, Sauerstoff freigesetzt und im Calvin-Zyklus Kohlenstoffdioxid zu Glucose reduziert. ")
+    for n in range(pages):
+        page = doc.new_page()
+        if n % 4 == 3:
+            pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 850, 1100), False)
+            pixmap.set_rect(pixmap.irect, (235, 230, 220))
+            page.insert_image(page.rect, pixmap=pixmap)
+        else:
+            page.insert_textbox(fitz.Rect(50, 50, 545, 790), f"Kapitel {n + 1}\n\n" + paragraph * 12, fontsize=10)
+    doc.save(path)
+    doc.close()
+
+
+def make_background(path, seconds=30):
+    subprocess.run([
+        imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={seconds}",
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", path
+    ], check=True)
+
+
+#----------------------- Emulator -----------------------#
+def start_emulator(seed, latency_ms, tokens_per_second):
+    # fixed latency (sigma 0) so the model stages dont add noise to the numbers
+    emulator.emulator_config.update({
+        "latency_median_ms": latency_ms, "latency_sigma": 0.0, "tokens_per_second": tokens_per_second,
+        "error_rate": 0.0, "rate_limit_rate": 0.0, "requests_per_minute": 0, "malformed_rate": 0.0
+    })
+    emulator.emulator_config.pop("tts", None)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(emulator.make_app(seed))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, name="emulator", daemon=True).start()
+    return f"127.0.0.1:{port}"
+
+
+def point_libs_at(address, workdir, args):
+    import edge_tts.communicate
+    ai.GEMINI_BASE_URL = f"http://{address}"
+    ai.OPENAI_BASE_URL = f"http://{address}/v1"
+    edge_tts.communicate.WSS_URL = f"ws://{address}/edge-tts/v1?TrustedClientToken=benchmark"
+    # caches would turn the second repeat into a cache benchmark
+    ai.RESPONSE_CACHE_ENABLED = False
+    video.STOCK_VIDEO_DIR = os.path.join(workdir, "stock")
+    video.PROXY_DIR = os.path.join(workdir, "proxies")
+    video.SCRATCH_DIR = os.path.join(workdir, "scratch")
+    if args.subtitle_mode:
+        video.SUBTITLE_MODE = args.subtitle_mode
+    if args.encode_workers is not None:
+        encode.ENCODE_WORKERS = args.encode_workers
+
+
+#----------------------- Recording -----------------------#
+class Recorder:
+    def __init__(self):
+        self.pipeline = None
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, name, wall, cpu, peak_rss):
+        if self.pipeline is None:
+            return
+        with self.lock:
+            entry = self.samples.setdefault(self.pipeline, {}).setdefault(name, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0})
+            entry["count"] += 1
+            entry["wall_s"] += wall
+            entry["cpu_s"] += cpu
+            if peak_rss:
+                entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak_rss / 1024 / 1024)
+
+    def take(self, pipeline):
+        with self.lock:
+            return self.samples.pop(pipeline, {})
+
+
+def run_pipeline(recorder, name, func):
+    # returns (stages, whatever func returned)
+    recorder.pipeline = name
+    try:
+        with perf.stage(f"{name}.total"):
+            result = func()
+    finally:
+        recorder.pipeline = None
+    return recorder.take(name), result
+
+
+def bench_extract(workdir, pdf_path):
+    ai.PAGE_CACHE_DIR = tempfile.mkdtemp(prefix="page_cache_", dir=workdir)   # cold page cache every run
+    ai._page_cache_budget = ai.DiskBudget(ai.PAGE_CACHE_DIR, ai.PAGE_CACHE_MAX_MB * 1024 * 1024, name="page-cache")
+    with perf.stage("extract.analysis"):
+        response = ai.prompt_gemini_multimodal(ANALYSIS_PROMPT, files=[pdf_path], use_cache=False)
+    analysis = response["candidates"][0]["content"]["parts"][0]["text"]
+    with perf.stage("extract.plan"):
+        ai.prompt_gemini_json(ai.google_ai_studio_key, PLAN_PROMPT + analysis, schemas.PLAN_SCHEMA)
+
+
+def bench_video(workdir, script):
+    video.TTS_CACHE_DIR = tempfile.mkdtemp(prefix="tts_cache_", dir=workdir)   # cold tts cache every run
+    video._tts_cache_budget = video.DiskBudget(video.TTS_CACHE_DIR, video.TTS_CACHE_MAX_MB * 1024 * 1024, name="tts-cache")
+    encode.caption_cache.clear()
+    output = os.path.join(workdir, "video.mp4")
+    if script is None:
+        # full pipeline including the script from the (emulated) model
+        video.make_video("Photosynthese", "Licht- und Dunkelreaktion", "Die Photosynthese ...", output)
+    else:
+        video.generate_podcast_video(script, output, "mc")
+    # seconds of video produced, turns the stage times into a realtime factor
+    clip = video.VideoFileClip(output)
+    duration = clip.duration
+    clip.close()
+    return duration
+
+
+def summarize(runs):
+    """
+    Median wall/cpu per stage over the repeats, max peak rss.
+    """
+    stages = {}
+    for run in runs:
+        for name, entry in run.items():
+            stages.setdefault(name, []).append(entry)
+    summary = {}
+    for name, entries in sorted(stages.items()):
+        summary[name] = {
+            "count": entries[0]["count"],
+            "wall_s": round(statistics.median(e["wall_s"] for e in entries), 4),
+            "cpu_s": round(statistics.median(e["cpu_s"] for e in entries), 4),
+            "peak_rss_mb": round(max(e["peak_rss_mb"] for e in entries), 1),
+            "runs": len(entries)
+        }
+    return summary
+
+
+#----------------------- Comparison -----------------------#
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Returns the stages that got slower than the baseline by more than threshold (relative) and min_seconds (absolute).
+    """
+    regressions = []
+    print(f"\n{'stage':<32}{'metric':<8}{'baseline':>10}{'current':>10}{'change':>9}")
+    for pipeline, data in results["pipelines"].items():
+        base_stages = baseline.get("pipelines", {}).get(pipeline, {}).get("stages", {})
+        for name, entry in data["stages"].items():
+            base = base_stages.get(name)
+            if not base:
+                continue
+            for metric in ("wall_s", "cpu_s"):
+                old, new = base[metric], entry[metric]
+                change = (new - old) / old if old else 0.0
+                flag = ""
+                if new - old > min_seconds and change > threshold:
+                    flag = "  <-- regression"
+                    regressions.append({"stage": name, "metric": metric, "baseline": old, "current": new})
+                print(f"{name:<32}{metric:<8}{old:>10.3f}{new:>10.3f}{change:>+9.0%}{flag}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extract and video pipelines against the local emulator")
+    parser.add_argument("--pipelines", default="extract,video", help="comma separated: extract, video")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--pages", type=int, default=12, help="pages of the generated fixture pdf")
+    parser.add_argument("--script", default=os.path.join(FIXTURE_DIR, "podcast_script.txt"),
+                        help="fixture script for the video, 'model' = let the emulated model write it")
+    parser.add_argument("--subtitle-mode", choices=("tts", "whisper"), default=None)
+    parser.add_argument("--encode-workers", type=int, default=None)
+    parser.add_argument("--latency-ms", type=float, default=200, help="emulated time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=2000, help="emulated output speed")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--out", default=os.path.join("bench", "results.json"))
+    parser.add_argument("--compare", default=None, help="baseline json to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results to bench/baseline.json")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown that counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.1, help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    pipelines = [p.strip() for p in args.pipelines.split(",") if p.strip()]
+    workdir = tempfile.mkdtemp(prefix="study_helper_bench_")
+    recorder = Recorder()
+    perf.add_listener(recorder)
+    perf.start_rss_sampling()
+
+    try:
+        point_libs_at(start_emulator(args.seed, args.latency_ms, args.tokens_per_second), workdir, args)
+        pdf_path = os.path.join(workdir, "course.pdf")
+        make_fixture_pdf(pdf_path, args.pages)
+        os.makedirs(video.STOCK_VIDEO_DIR, exist_ok=True)
+        make_background(os.path.join(video.STOCK_VIDEO_DIR, "mc.mp4"))
+        # the proxy is built once per stock video in real life too, keep it out of the numbers
+        video.get_background_proxy("mc")
+        script = None
+        if args.script != "model":
+            with open(args.script, "r", encoding="utf-8") as f:
+                script = f.read()
+
+        results = {"meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args)
+        }, "pipelines": {}}
+
+        benches = {
+            "extract": lambda: bench_extract(workdir, pdf_path),
+            "video": lambda: bench_video(workdir, script)
+        }
+        for pipeline in pipelines:
+            if pipeline not in benches:
+                parser.error(f"unknown pipeline: {pipeline}")
+            runs = []
+            for i in range(args.repeat):
+                print(f"\n=== {pipeline} run {i + 1}/{args.repeat} ===")
+                stages, output = run_pipeline(recorder, pipeline, benches[pipeline])
+                runs.append(stages)
+            summary = summarize(runs)
+            results["pipelines"][pipeline] = {"stages": summary}
+            if pipeline == "video":
+                results["pipelines"][pipeline]["video_seconds"] = round(output, 2)
+                results["pipelines"][pipeline]["video_seconds_per_wall_second"] = round(output / summary["video.total"]["wall_s"], 3)
+
+        import resource
+        results["meta"]["children_peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    finally:
+        perf.stop_rss_sampling()
+        perf.remove_listener(recorder)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.out}")
+    if args.save_baseline:
+        with open(os.path.join("bench", "baseline.json"), "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print("Saved as baseline")
+
+    for pipeline, data in results["pipelines"].items():
+        print(f"\n{pipeline}:")
+        for name, entry in data["stages"].items():
+            print(f"  {name:<30}{entry['wall_s']:>9.3f}s wall{entry['cpu_s']:>9.3f}s cpu{entry['peak_rss_mb']:>9.1f} MB  x{entry['count']}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.compare}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
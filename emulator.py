@@ -0,0 +1,411 @@
+# Local stand-in for the parts of Gemini (generateContent / streamGenerateContent), OpenAI (responses.create)
+# and edge-tts (the readaloud websocket) that this app uses. Load tests and benchmarks run against it
+# offline, without quota and without network variance.
+#
+#   python emulator.py --port 8089
+#
+# then point [Endpoints] in config.toml at it. Latency, throughput, error/429 injection and canned
+# answers are configured in [Emulator] (defaults) and [Emulator.gemini] / [Emulator.openai] / [Emulator.tts].
+
+import argparse
+import asyncio
+import hashlib
+import html
+import json
+import math
+import random
+import re
+import time
+import uuid
+from collections import deque
+
+import tomllib
+from aiohttp import web
+
+with open("config.toml", "rb") as f:
+    config = tomllib.load(f)
+
+emulator_config = config.get("Emulator", {})
+
+DEFAULTS = {
+    "latency_median_ms": 400,         # time to first token, lognormal around the median
+    "latency_sigma": 0.5,
+    "tokens_per_second": 200,         # output speed after the first token
+    "error_rate": 0.0,                # share of requests that get a 500/503
+    "rate_limit_rate": 0.0,           # share of requests that get a 429
+    "requests_per_minute": 0,         # hard quota, everything above gets a 429 (0 = none)
+    "retry_after_seconds": 2,
+    "malformed_rate": 0.0,            # share of json answers that come back fenced (repairable) or cut off (not)
+    "seconds_per_word": 0.35,         # tts: audio length per word
+    "realtime_factor": 0.05,          # tts: synthesis time per second of audio
+    "script_lines": 30,               # podcast scripts: number of lines
+    "analysis_paragraphs": 6,         # document analyses: number of paragraphs
+    "text_tokens": 300,               # everything else: length of the answer
+}
+
+WORDS = ("lernen wissen system prozess energie modell funktion struktur daten wert analyse methode "
+         "beispiel grundlage theorie praxis formel ergebnis faktor element form kraft zeit raum "
+         "learning concept process value model function structure method result basis theory").split()
+
+# 1x1 png for the image model
+PNG_PIXEL = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+
+
+class Provider:
+    """
+    Behaviour of one emulated provider: latency, throughput, injected errors and the rpm quota.
+    All randomness comes from one seeded rng so runs are reproducible.
+    """
+    def __init__(self, name, seed):
+        self.name = name
+        self.settings = {**DEFAULTS, **{k: v for k, v in emulator_config.items() if not isinstance(v, dict)},
+                         **emulator_config.get(name, {})}
+        self.rng = random.Random(f"{seed}-{name}")
+        self.recent = deque()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "malformed": 0}
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def fault(self):
+        """
+        Returns (status, message) for an injected failure, or None.
+        """
+        self.stats["requests"] += 1
+        now = time.monotonic()
+        quota = self["requests_per_minute"]
+        if quota:
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            if len(self.recent) >= quota:
+                self.stats["rate_limited"] += 1
+                return 429, "Quota exceeded (emulated requests_per_minute)"
+            self.recent.append(now)
+        roll = self.rng.random()
+        if roll < self["rate_limit_rate"]:
+            self.stats["rate_limited"] += 1
+            return 429, "Resource exhausted (emulated)"
+        if roll < self["rate_limit_rate"] + self["error_rate"]:
+            self.stats["errors"] += 1
+            return self.rng.choice((500, 503)), "Internal error (emulated)"
+        return None
+
+    def first_token_delay(self):
+        median = self["latency_median_ms"] / 1000
+        return median * math.exp(self.rng.gauss(0, self["latency_sigma"])) if median else 0.0
+
+    def generation_time(self, tokens):
+        rate = self["tokens_per_second"]
+        return tokens / rate if rate else 0.0
+
+    def maybe_malform(self, text):
+        if self.rng.random() >= self["malformed_rate"]:
+            return text
+        self.stats["malformed"] += 1
+        if self.rng.random() < 0.5:
+            return f"```json\n{text}\n```"
+        return text[:len(text) // 2]
+
+
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+
+#----------------------- Answers -----------------------#
+def _content_rng(prompt):
+    # the content only depends on the prompt, so the same request gives the same answer (like a cache would)
+    return random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+
+
+def _sentence(rng, words=12):
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def _title(rng, words=2):
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(words))
+
+
+def plan_answer(rng):
+    return {"chapters": [{
+        "title": _title(rng),
+        "summary": _sentence(rng, 4).rstrip("."),
+        "subtopics": [{"title": _title(rng), "description": _sentence(rng, 4).rstrip(".")} for _ in range(3)]
+    } for _ in range(rng.randint(3, 5))]}
+
+
+def quiz_answer(rng, count):
+    questions = []
+    for i in range(count):
+        options = [_title(rng, 3) for _ in range(4)]
+        questions.append({"question": f"{i + 1}. {_sentence(rng, 8)[:-1]}?", "options": options, "answer": rng.choice(options)})
+    return {"questions": questions}
+
+
+def notes_answer(rng, title):
+    def bullets(n=3):
+        return "\n".join(f"- {_sentence(rng, 8)}" for _ in range(n))
+    terms = "\n".join(f"- **{_title(rng, 1)}**: {_sentence(rng, 6)}" for _ in range(3))
+    return (f"# {title}\n{_sentence(rng, 20)}\n\n---\n\n## 💡 Key Concepts\n{bullets()}\n\n---\n\n"
+            f"## 🏷️ Important Terms\n{terms}\n\n---\n\n## ⚡ Quick Facts\n{bullets()}\n\n---\n")
+
+
+def chapter_answer(rng, prompt):
+    subtopics = re.findall(r'^\s*(\d+): "(.*?)"', prompt, re.MULTILINE)
+    return {"subtopics": [{"index": int(i), "notes": notes_answer(rng, title), "quiz": quiz_answer(rng, 10)}
+                          for i, title in subtopics]}
+
+
+def script_answer(rng, lines):
+    return "\n\n".join(f"{'Tom' if i % 2 == 0 else 'Lisa'}: {_sentence(rng, rng.randint(10, 25))}" for i in range(lines))
+
+
+def analysis_answer(rng, paragraphs):
+    sections = []
+    for i in range(paragraphs):
+        sections.append(f"## {_title(rng)}\n" + " ".join(_sentence(rng, rng.randint(10, 20)) for _ in range(5)))
+    return f"# {_title(rng, 3)}\n\n" + "\n\n".join(sections)
+
+
+def text_answer(provider, prompt, schema=None):
+    """
+    Picks a fitting answer for one of the app's prompts (schema first, then the wording of the prompt).
+    """
+    rng = _content_rng(prompt)
+    for canned in emulator_config.get("canned", []):
+        if re.search(canned["match"], prompt):
+            with open(canned["file"], "r", encoding="utf-8") as f:
+                return f.read()
+
+    properties = (schema or {}).get("properties", {})
+    if "chapters" in properties or ('"chapters"' in prompt and "learning plan" in prompt):
+        return provider.maybe_malform(json.dumps(plan_answer(rng), ensure_ascii=False))
+    if "subtopics" in properties or "Create study material for these subtopics" in prompt:
+        return provider.maybe_malform(json.dumps(chapter_answer(rng, prompt), ensure_ascii=False))
+    if "questions" in properties or "multiple-choice quiz" in prompt:
+        count = re.search(r"Create a (\d+)-question", prompt)
+        return provider.maybe_malform(json.dumps(quiz_answer(rng, int(count.group(1)) if count else 10), ensure_ascii=False))
+    if "cheat sheet in Markdown" in prompt:
+        title = re.search(r'subtopic:\s*"(.*?)"', prompt)
+        return notes_answer(rng, title.group(1) if title else _title(rng))
+    if "Tom:" in prompt and "Lisa:" in prompt:
+        return script_answer(rng, provider["script_lines"])
+    if "Analyze the provided documents" in prompt or "Merge them into one" in prompt:
+        return analysis_answer(rng, provider["analysis_paragraphs"])
+    words = max(1, provider["text_tokens"] * 3 // 4)
+    return " ".join(_sentence(rng, 15) for _ in range(max(1, words // 15)))
+
+
+#----------------------- Gemini -----------------------#
+def _gemini_error(status, message):
+    names = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+    headers = {"Retry-After": str(providers["gemini"]["retry_after_seconds"])} if status == 429 else None
+    return web.json_response({"error": {"code": status, "message": message, "status": names.get(status, "UNKNOWN")}},
+                             status=status, headers=headers)
+
+
+def _gemini_prompt(payload):
+    texts = []
+    for content in payload.get("contents", []):
+        for part in content.get("parts", []):
+            if "text" in part:
+                texts.append(part["text"])
+    return "\n".join(texts)
+
+
+def _gemini_usage(prompt_tokens, output_tokens):
+    return {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens, "totalTokenCount": prompt_tokens + output_tokens}
+
+
+async def gemini(request):
+    model, _, action = request.match_info["model_action"].partition(":")
+    provider = providers["gemini"]
+    payload = await request.json()
+    fault = provider.fault()
+    if fault:
+        await asyncio.sleep(provider.first_token_delay() / 4)
+        return _gemini_error(*fault)
+
+    prompt = _gemini_prompt(payload)
+    generation_config = payload.get("generationConfig", {})
+    prompt_tokens = count_tokens(prompt) + 258 * sum(
+        "inlineData" in part for content in payload.get("contents", []) for part in content.get("parts", []))
+
+    if "IMAGE" in generation_config.get("responseModalities", []):
+        await asyncio.sleep(provider.first_token_delay())
+        parts = [{"text": "Here is your image."}, {"inlineData": {"mimeType": "image/png", "data": PNG_PIXEL}}]
+        return web.json_response({"candidates": [{"content": {"parts": parts, "role": "model"}, "finishReason": "STOP"}],
+                                  "usageMetadata": _gemini_usage(prompt_tokens, 1290), "modelVersion": model})
+
+    text = text_answer(provider, prompt, generation_config.get("responseSchema"))
+    output_tokens = count_tokens(text)
+
+    if action == "streamGenerateContent":
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        await asyncio.sleep(provider.first_token_delay())
+        # gemini sends a few dozen tokens per event
+        chunk_chars = 120
+        for start in range(0, len(text), chunk_chars):
+            chunk = text[start:start + chunk_chars]
+            last = start + chunk_chars >= len(text)
+            event = {"candidates": [{"content": {"parts": [{"text": chunk}], "role": "model"}}], "modelVersion": model}
+            if last:
+                event["candidates"][0]["finishReason"] = "STOP"
+                event["usageMetadata"] = _gemini_usage(prompt_tokens, output_tokens)
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+            await asyncio.sleep(provider.generation_time(count_tokens(chunk)))
+        await response.write_eof()
+        return response
+
+    await asyncio.sleep(provider.first_token_delay() + provider.generation_time(output_tokens))
+    return web.json_response({
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+        "usageMetadata": _gemini_usage(prompt_tokens, output_tokens),
+        "modelVersion": model
+    })
+
+
+#----------------------- OpenAI -----------------------#
+async def openai_responses(request):
+    provider = providers["openai"]
+    payload = await request.json()
+    fault = provider.fault()
+    if fault:
+        status, message = fault
+        headers = {"retry-after": str(provider["retry_after_seconds"])} if status == 429 else None
+        kind = "rate_limit_error" if status == 429 else "server_error"
+        return web.json_response({"error": {"message": message, "type": kind, "code": None, "param": None}},
+                                 status=status, headers=headers)
+
+    prompt = payload.get("input", "")
+    if not isinstance(prompt, str):
+        prompt = json.dumps(prompt)
+    text = text_answer(provider, prompt)
+    input_tokens, output_tokens = count_tokens(prompt), count_tokens(text)
+    await asyncio.sleep(provider.first_token_delay() + provider.generation_time(output_tokens))
+
+    response_id = f"resp_{uuid.uuid4().hex}"
+    return web.json_response({
+        "id": response_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": payload.get("model", "emulated"),
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}]
+        }],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "error": None,
+        "incomplete_details": None,
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens
+        }
+    })
+
+
+#----------------------- edge-tts -----------------------#
+# mpeg-1 layer III, 128 kbit/s, 48 kHz, mono, no padding = 384 bytes and 24 ms per frame.
+# all-zero side info decodes to silence, so we can make mp3s of any length without an encoder
+_MP3_FRAME = bytes((0xFF, 0xFB, 0x94, 0xC0)) + bytes(380)
+_MP3_FRAME_SECONDS = 1152 / 48000
+
+
+def silent_mp3(seconds):
+    return _MP3_FRAME * max(1, round(seconds / _MP3_FRAME_SECONDS))
+
+
+def _ssml_text(ssml):
+    match = re.search(r"<prosody[^>]*>(.*?)</prosody>", ssml, re.DOTALL)
+    return html.unescape(match.group(1) if match else re.sub(r"<[^>]+>", " ", ssml)).strip()
+
+
+def _tts_text_message(request_id, path, body):
+    return (f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\n"
+            f"Path:{path}\r\n\r\n{json.dumps(body)}")
+
+
+def _tts_audio_message(request_id, audio):
+    # 2 byte header length, headers (ending in \r\n), then the mp3 data
+    headers = f"X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\nPath:audio\r\n".encode("utf-8")
+    return len(headers).to_bytes(2, "big") + headers + audio
+
+
+async def edge_tts_socket(request):
+    provider = providers["tts"]
+    fault = provider.fault()
+    if fault:
+        # edge-tts sees this as a failed websocket handshake with that status
+        return web.Response(status=fault[0], text=fault[1])
+
+    socket = web.WebSocketResponse()
+    await socket.prepare(request)
+    async for message in socket:
+        if message.type != web.WSMsgType.TEXT:
+            continue
+        head, _, body = message.data.partition("\r\n\r\n")
+        if "Path:ssml" not in head:
+            continue   # speech.config
+        request_id = re.search(r"X-RequestId:(\w+)", head)
+        request_id = request_id.group(1) if request_id else uuid.uuid4().hex
+        words = _ssml_text(body).split()
+
+        await asyncio.sleep(provider.first_token_delay())
+        await socket.send_str(_tts_text_message(request_id, "turn.start", {"context": {"serviceTag": "emulator"}}))
+        offset = 0.0
+        for word in words:
+            duration = provider["seconds_per_word"]
+            # edge-tts times are in 100ns ticks
+            await socket.send_str(_tts_text_message(request_id, "audio.metadata", {"Metadata": [{
+                "Type": "WordBoundary",
+                "Data": {"Offset": int(offset * 10_000_000), "Duration": int(duration * 8_000_000),
+                         "text": {"Text": word, "Length": len(word), "BoundaryType": "WordBoundary"}}
+            }]}))
+            await socket.send_bytes(_tts_audio_message(request_id, silent_mp3(duration)))
+            await asyncio.sleep(duration * provider["realtime_factor"])
+            offset += duration
+        await socket.send_str(_tts_text_message(request_id, "turn.end", {}))
+    return socket
+
+
+#----------------------- Server -----------------------#
+providers = {}
+
+
+async def stats(request):
+    return web.json_response({name: provider.stats for name, provider in providers.items()})
+
+
+def make_app(seed=None):
+    seed = emulator_config.get("seed", 1234) if seed is None else seed
+    for name in ("gemini", "openai", "tts"):
+        providers[name] = Provider(name, seed)
+    app = web.Application(client_max_size=256 * 1024 * 1024)   # multimodal requests carry whole pdfs
+    app.router.add_post("/v1beta/models/{model_action}", gemini)
+    app.router.add_post("/v1/responses", openai_responses)
+    app.router.add_get("/edge-tts/v1", edge_tts_socket)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Gemini, OpenAI and edge-tts endpoints")
+    parser.add_argument("--host", default=emulator_config.get("host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=emulator_config.get("port", 8089))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    web.run_app(make_app(args.seed), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,34 @@
-import requests
+import httpx
 import json
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError
+import asyncio
+import queue
+import random
+import contextvars
+from contextlib import contextmanager
 
 
 import fitz
 import base64
-import requests
 import json
 import os
 
 import mimetypes
+import sqlite3
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from google import genai
 from google.genai import types
 
+import lib_schema_utilities as schemas
+import lib_perf_utilities as perf
+import lib_metrics_utilities as metrics
+from lib_disk_cache_utilities import DiskBudget
+import lib_render_utilities as render
+
 # setup
 import tomllib
 # Read the TOML file
@@ -28,30 +44,593 @@ google_ai_studio_key = config["Api_keys"]["Gemini"]
 
 os.environ['OPENAI_API_KEY'] = config["Api_keys"]["OpenAi"]
 
-def prompt_chat_gpt(model, prompt):
-    print("prompting...")
-    client = OpenAI()
+GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
+
+# prompt_gemini reports errors as strings starting with one of these
+GEMINI_ERROR_PREFIXES = ("HTTP Error", "Error Connecting", "Timeout Error", "Something went wrong", "Error parsing response", "No text generated.")
+
+
+def is_error_response(text):
+    return not isinstance(text, str) or text.startswith(GEMINI_ERROR_PREFIXES)
+
+
+#----------------------- HTTP clients -----------------------#
+# one pooled keep-alive client per process instead of a fresh connection (dns + tcp + tls) for every call.
+# all network calls run on one background event loop that owns the async clients, so
+# - the *_async functions can be awaited from any event loop (they hop over to that loop)
+# - the sync functions are thin wrappers that block on the same coroutines from any thread
+http_config = config.get("Http", {})
+HTTP_MAX_CONNECTIONS = http_config.get("max_connections", 20)
+HTTP_MAX_KEEPALIVE = http_config.get("max_keepalive", 10)
+HTTP_TIMEOUT = http_config.get("timeout_seconds", 300)
+HTTP_CONNECT_TIMEOUT = http_config.get("connect_timeout_seconds", 10)
+HTTP2 = http_config.get("http2", True)
+
+if HTTP2:
+    try:
+        import h2  # httpx only speaks http/2 when this is installed (pip install httpx[http2])
+    except ImportError:
+        print("h2 not installed, using HTTP/1.1 keep-alive connections")
+        HTTP2 = False
+
+# empty = the real services, set them to emulator.py (see config.toml) to run without network/quota
+endpoints_config = config.get("Endpoints", {})
+GEMINI_DEFAULT_URL = "https://generativelanguage.googleapis.com"
+GEMINI_BASE_URL = (endpoints_config.get("gemini_base_url") or GEMINI_DEFAULT_URL).rstrip("/")
+OPENAI_BASE_URL = endpoints_config.get("openai_base_url") or None
+
+_io_loop = None
+_http_client = None
+_openai_client = None
+_client_lock = threading.Lock()
+
+
+def _get_io_loop():
+    global _io_loop
+    if _io_loop is None:
+        with _client_lock:
+            if _io_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ai-io-loop", daemon=True).start()
+                _io_loop = loop
+    return _io_loop
+
+
+async def _on_io_loop(coro):
+    # run a coroutine on the shared io loop and wait for it from whatever loop we are on
+    loop = _get_io_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine of this module on the shared io loop and blocks until it is done.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_io_loop()).result()
+
+
+def _new_httpx_client():
+    return httpx.AsyncClient(
+        http2=HTTP2,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    )
+
+
+def http_client():
+    """
+    Shared client for the Gemini REST calls (only use it on the io loop).
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = _new_httpx_client()
+    return _http_client
+
+
+def openai_client():
+    """
+    Shared OpenAI client with the same pool settings (only use it on the io loop).
+    """
+    global _openai_client
+    if _openai_client is None:
+        # no sdk retries: they would run inside every scheduled attempt and hide the 429s from the limiter
+        _openai_client = AsyncOpenAI(http_client=_new_httpx_client(), base_url=OPENAI_BASE_URL, max_retries=0)
+    return _openai_client
+
+
+#----------------------- Scheduler -----------------------#
+# every outbound call to a provider (gemini, openai, edge-tts) goes through one limiter per provider and process:
+# token buckets for requests/min and tokens/min, a concurrency cap, backoff on 429/5xx and a circuit breaker.
+# the limiters arent bound to an event loop (tts runs on its own loops), state is guarded by a plain lock.
+INTERACTIVE, NORMAL, BACKGROUND = 0, 1, 2   # lower goes first
+
+scheduler_config = config.get("Scheduler", {})
+SCHEDULER_RETRIES = scheduler_config.get("max_retries", 4)
+BACKOFF_BASE = scheduler_config.get("backoff_base_seconds", 1.0)
+BACKOFF_MAX = scheduler_config.get("backoff_max_seconds", 60.0)
+BURST_SECONDS = scheduler_config.get("burst_seconds", 10)                  # bucket size = this many seconds of quota
+BREAKER_FAILURES = scheduler_config.get("breaker_failures", 5)             # consecutive failures that open the circuit
+BREAKER_COOLDOWN = scheduler_config.get("breaker_cooldown_seconds", 30)
+BACKGROUND_RESERVE = scheduler_config.get("background_reserve", 0.2)       # share of the buckets background calls leave alone
+
+# per provider defaults, 0 = no limit. override them in [Scheduler.<provider>]
+PROVIDER_LIMITS = {
+    "gemini": {"requests_per_minute": 60, "tokens_per_minute": 1_000_000, "max_concurrency": 8},
+    "gemini-image": {"requests_per_minute": 10, "tokens_per_minute": 0, "max_concurrency": 2},
+    "openai": {"requests_per_minute": 500, "tokens_per_minute": 200_000, "max_concurrency": 8},
+    "edge-tts": {"requests_per_minute": 180, "tokens_per_minute": 0, "max_concurrency": 4},
+}
+
+_POLL = 0.25
+_priority = contextvars.ContextVar("ai_priority", default=NORMAL)
+
+
+@contextmanager
+def priority(level):
+    """
+    Sets the priority class (INTERACTIVE, NORMAL, BACKGROUND) for every model call made inside the block,
+    including calls that hop over to the io loop or run in asyncio.run() further down.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    The provider failed too often in a row, calls fail fast until the cooldown is over.
+    """
+
+
+class _Bucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_for(self, amount):
+        # seconds until `amount` is available (never more than a full bucket, big requests just drain it)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+
+class ProviderLimiter:
+    """
+    Rate limits, concurrency cap and circuit breaker for one provider.
+
+    Args:
+        name (str): Provider name (only for logs and stats).
+        requests_per_minute (float): Request quota, 0 = unlimited.
+        tokens_per_minute (float): Token quota, 0 = unlimited.
+        max_concurrency (int): Calls in flight at the same time, 0 = unlimited.
+        max_retries (int): Retries for 429/5xx/connection errors.
+    """
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, max_concurrency=0, max_retries=None):
+        self.name = name
+        self.requests = _Bucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = _Bucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = SCHEDULER_RETRIES if max_retries is None else max_retries
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = [0, 0, 0]
+        self.blocked_until = 0.0
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "throttled": 0, "breaker_opens": 0, "rejected": 0, "wait_seconds": 0.0}
+
+    def _try_acquire(self, level, tokens):
+        # returns 0 if the caller got a slot, otherwise how long to wait before asking again
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < BREAKER_COOLDOWN:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(f"{self.name} circuit open after {self.failures} failures, retry in {BREAKER_COOLDOWN - (now - self.opened_at):.0f}s")
+                self.state = "half_open"
+            if self.state == "half_open" and self.probing:
+                # one probe at a time, the rest waits for its verdict
+                return _POLL
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if any(self.waiting[:level]):
+                return _POLL
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                return _POLL
+
+            reserve = BACKGROUND_RESERVE if level >= BACKGROUND else 0
+            wait = 0.0
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket is None or not amount:
+                    continue
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_for(amount + reserve * bucket.capacity))
+            if wait > 0:
+                return wait
+
+            if self.requests:
+                self.requests.level -= 1
+            if self.tokens:
+                self.tokens.level -= tokens
+            self.in_flight += 1
+            self.stats["calls"] += 1
+            if self.state == "half_open":
+                self.probing = True
+            return 0.0
+
+    async def acquire(self, level=NORMAL, tokens=0):
+        registered = False
+        started = time.monotonic()
+        try:
+            while True:
+                wait = self._try_acquire(level, tokens)
+                if wait <= 0:
+                    return
+                if not registered:
+                    with self.lock:
+                        self.waiting[level] += 1
+                        self.stats["throttled"] += 1
+                    registered = True
+                await asyncio.sleep(min(wait, 5.0))
+        finally:
+            with self.lock:
+                if registered:
+                    self.waiting[level] -= 1
+                self.stats["wait_seconds"] += time.monotonic() - started
+
+    def release(self, ok=True, estimated=0, used=None):
+        """
+        Frees the slot. ok=False counts towards the circuit breaker, ok=None (cancelled call) leaves it alone,
+        used corrects the token bucket with the real usage.
+        """
+        with self.lock:
+            self.in_flight -= 1
+            if self.tokens and used is not None:
+                self.tokens.level -= used - estimated
+            if ok is None:
+                # a cancelled half open probe proved nothing, let the next call probe again
+                self.probing = False
+                return
+            if ok:
+                self.failures = 0
+                if self.state == "half_open":
+                    print(f"[scheduler] {self.name} recovered, closing circuit")
+                    self.state = "closed"
+                self.probing = False
+                return
+            self.failures += 1
+            self.stats["failures"] += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= BREAKER_FAILURES):
+                print(f"[scheduler] {self.name} failed {self.failures}x in a row, opening circuit for {BREAKER_COOLDOWN}s")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.stats["breaker_opens"] += 1
+
+    def pause(self, seconds):
+        # a 429 means the quota is gone for everybody, not just for the caller that got it
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def summary(self):
+        with self.lock:
+            return {**self.stats, "state": self.state, "in_flight": self.in_flight, "waiting": sum(self.waiting)}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider):
+    with _limiters_lock:
+        if provider not in _limiters:
+            limits = {**PROVIDER_LIMITS.get(provider, {}), **scheduler_config.get(provider, {})}
+            _limiters[provider] = ProviderLimiter(provider, **limits)
+        return _limiters[provider]
+
+
+def scheduler_summary():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.summary() for name, limiter in limiters.items()}
+
+
+def _status_code(error):
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None) or getattr(error, "status", None)
+    return status if isinstance(status, int) else None
+
 
-    response = client.responses.create(
-        model=model,
-        input=prompt
+def _retryable(error):
+    status = _status_code(error)
+    if status is not None:
+        return status in (408, 429) or status >= 500
+    return isinstance(error, (httpx.TransportError, APIConnectionError, ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+def _backoff_delay(error, attempt, base=None):
+    # exponential with jitter so a bunch of callers that failed together dont come back together
+    delay = min(BACKOFF_MAX, (base or BACKOFF_BASE) * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        delay = max(delay, min(BACKOFF_MAX, float(headers.get("retry-after", 0))))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+async def scheduled(provider, make_call, tokens=0, usage=None, retry_on=None, retries=None, model="", backoff_base=None):
+    """
+    Runs make_call() through the provider's limiter and retries it with backoff on 429/5xx/connection errors.
+
+    Args:
+        provider (str): Key for the limiter ("gemini", "openai", "edge-tts", ...).
+        make_call (callable): Returns a new coroutine for every attempt.
+        tokens (int): Estimated tokens of the call (for the tokens/min bucket).
+        usage (callable): Gets the result and returns the real (input, output) token counts (or None).
+        retry_on (callable): Decides if an exception is worth a retry, defaults to 429/5xx/connection errors.
+        retries (int): Overrides the provider's max_retries.
+        model (str): Model (or voice) for the metrics.
+        backoff_base (float): Overrides the first retry delay ([Scheduler] backoff_base_seconds).
+
+    Raises:
+        CircuitOpenError: If the provider's circuit is open.
+        The last exception of make_call() if the retries are used up or it isnt retryable.
+    """
+    limiter = get_limiter(provider)
+    level = _priority.get()
+    retry_on = retry_on or _retryable
+    max_retries = limiter.max_retries if retries is None else retries
+    attempt = 0
+    while True:
+        await limiter.acquire(level, tokens)
+        started = time.perf_counter()
+        try:
+            with perf.stage(f"model.{provider}"):
+                result = await make_call()
+        except asyncio.CancelledError:
+            limiter.release(ok=None, estimated=tokens)
+            raise
+        except Exception as e:
+            metrics.MODEL_LATENCY.observe(time.perf_counter() - started, provider=provider, model=model, outcome="error")
+            retry = retry_on(e)
+            limiter.release(ok=not retry, estimated=tokens)
+            if not retry or attempt >= max_retries:
+                raise
+            delay = _backoff_delay(e, attempt, backoff_base)
+            if _status_code(e) == 429:
+                limiter.pause(delay)
+            with limiter.lock:
+                limiter.stats["retries"] += 1
+            print(f"[scheduler] {provider} call failed ({e}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        metrics.MODEL_LATENCY.observe(time.perf_counter() - started, provider=provider, model=model, outcome="ok")
+        used = None
+        if usage:
+            try:
+                input_tokens, output_tokens = usage(result)
+                metrics.MODEL_TOKENS.inc(input_tokens, provider=provider, model=model, direction="input")
+                metrics.MODEL_TOKENS.inc(output_tokens, provider=provider, model=model, direction="output")
+                used = input_tokens + output_tokens
+            except (TypeError, ValueError, AttributeError, KeyError):
+                used = None
+        limiter.release(ok=True, estimated=tokens, used=used)
+        return result
+
+
+def estimate_tokens(payload):
+    """
+    Rough token count of a gemini payload for the tokens/min bucket (~4 chars per token, 258 per image).
+    """
+    total = 0
+    for content in payload.get("contents", []):
+        for part in content.get("parts", []):
+            if "text" in part:
+                total += len(part["text"]) // 4 + 1
+            elif "inlineData" in part:
+                total += 258
+    return total
+
+
+def _gemini_usage(response_data):
+    usage = response_data.get("usageMetadata", {})
+    return usage["promptTokenCount"], usage.get("candidatesTokenCount", 0)
+
+
+#----------------------- Response cache -----------------------#
+# byte-identical requests (same provider, model, prompt, files and params) are answered from a local sqlite file
+cache_config = config.get("Cache", {})
+RESPONSE_CACHE_ENABLED = cache_config.get("enabled", True)
+RESPONSE_CACHE_PATH = cache_config.get("path", "llm_cache.db")
+RESPONSE_CACHE_TTL = cache_config.get("ttl_seconds", 7 * 24 * 3600)
+RESPONSE_CACHE_MAX_MB = cache_config.get("max_mb", 200)
+
+response_cache_stats = {"hits": 0, "misses": 0, "stores": 0}
+_response_cache_lock = threading.Lock()
+
+
+def _response_cache_db():
+    db = sqlite3.connect(RESPONSE_CACHE_PATH, timeout=30)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
     )
-    return response.output_text
+    return db
+
+
+def response_cache_key(provider, model, prompt, files=(), params=None):
+    """
+    Hash of everything that changes the answer. Files go in by content hash, not by path.
+    """
+    entry = {
+        "provider": provider,
+        "model": model,
+        "prompt": prompt,
+        "files": [file_hash(f) for f in files],
+        "params": params or {}
+    }
+    # answers from an overridden endpoint (emulator.py) must never be served once we talk to the real service again.
+    # the real services keep the plain key, so existing cache entries stay valid
+    endpoint = {"gemini": GEMINI_BASE_URL if GEMINI_BASE_URL != GEMINI_DEFAULT_URL else None, "openai": OPENAI_BASE_URL}.get(provider)
+    if endpoint:
+        entry["endpoint"] = endpoint
+    raw = json.dumps(entry, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def response_cache_get(key):
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    db = _response_cache_db()
+    try:
+        row = db.execute("SELECT value, created_at FROM responses WHERE key=?", (key,)).fetchone()
+        now = time.time()
+        if row and (not RESPONSE_CACHE_TTL or now - row[1] < RESPONSE_CACHE_TTL):
+            db.execute("UPDATE responses SET last_used=? WHERE key=?", (now, key))
+            db.commit()
+            value = row[0]
+        else:
+            value = None
+    finally:
+        db.close()
+    with _response_cache_lock:
+        response_cache_stats["hits" if value is not None else "misses"] += 1
+    return value
+
+
+def response_cache_put(key, value):
+    if not RESPONSE_CACHE_ENABLED:
+        return
+    now = time.time()
+    size = len(value.encode("utf-8"))
+    db = _response_cache_db()
+    try:
+        db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, value, size, now, now)
+        )
+        # expired entries go first, then least recently used until we are under the size limit
+        if RESPONSE_CACHE_TTL:
+            db.execute("DELETE FROM responses WHERE created_at < ?", (now - RESPONSE_CACHE_TTL,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        max_bytes = RESPONSE_CACHE_MAX_MB * 1024 * 1024
+        if total > max_bytes:
+            for old_key, old_size in db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                db.execute("DELETE FROM responses WHERE key=?", (old_key,))
+                total -= old_size
+                if total <= max_bytes:
+                    break
+        db.commit()
+    finally:
+        db.close()
+    with _response_cache_lock:
+        response_cache_stats["stores"] += 1
+
+
+def _collect_metrics():
+    with _response_cache_lock:
+        stats = dict(response_cache_stats)
+    families = metrics.cache_families("llm_response", stats["hits"], stats["misses"])
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    scheduler = scheduler_summary()
+    families += [
+        ("model_calls_in_flight", "gauge", "Model/tts calls running right now",
+         [({"provider": name}, s["in_flight"]) for name, s in scheduler.items()]),
+        ("model_calls_waiting", "gauge", "Model/tts calls waiting for the rate limiter",
+         [({"provider": name}, s["waiting"]) for name, s in scheduler.items()]),
+        ("model_call_retries_total", "counter", "Retried model/tts calls (429/5xx/connection errors)",
+         [({"provider": name}, s["retries"]) for name, s in scheduler.items()]),
+        ("model_circuit_state", "gauge", "Circuit breaker state (0 closed, 1 half open, 2 open)",
+         [({"provider": name}, states[s["state"]]) for name, s in scheduler.items()]),
+    ]
+    return families
 
 
-def prompt_gemini(api_key: str, prompt: str) -> str:
+metrics.register_collector(_collect_metrics)
+
+
+def response_cache_summary():
+    with _response_cache_lock:
+        stats = dict(response_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+async def prompt_chat_gpt_async(model, prompt, use_cache=True):
+    key = response_cache_key("openai", model, prompt)
+    if use_cache:
+        cached = await asyncio.to_thread(response_cache_get, key)
+        if cached is not None:
+            return cached
+
+    print("prompting...")
+
+    async def call():
+        return await openai_client().responses.create(
+            model=model,
+            input=prompt
+        )
+
+    def used_tokens(response):
+        return response.usage.input_tokens, response.usage.output_tokens
+
+    response = await scheduled("openai", lambda: _on_io_loop(call()), tokens=len(prompt) // 4 + 1, usage=used_tokens, model=model)
+    output_text = response.output_text
+    if use_cache and output_text:
+        await asyncio.to_thread(response_cache_put, key, output_text)
+    return output_text
+
+
+def prompt_chat_gpt(model, prompt, use_cache=True):
+    return run_sync(prompt_chat_gpt_async(model, prompt, use_cache))
+
+
+async def _post_gemini(url, payload, provider="gemini", retries=None, backoff_base=None):
+    # returns the parsed json, raises httpx errors (after the scheduler's retries)
+    async def call():
+        response = await http_client().post(url, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    model = url.split("/models/", 1)[-1].split(":", 1)[0]
+    return await scheduled(provider, lambda: _on_io_loop(call()), tokens=estimate_tokens(payload), usage=_gemini_usage,
+                           retries=retries, model=model, backoff_base=backoff_base)
+
+
+async def prompt_gemini_async(api_key: str, prompt: str, use_cache: bool = True, response_schema: dict = None) -> str:
     """
     Sends a prompt to the Gemini API and returns the generated text.
 
     Args:
         api_key (str): Your Google AI Studio API key.
         prompt (str): The text prompt to send to the model.
+        use_cache (bool): Set to False to always ask the model (and not store the answer).
+        response_schema (dict): Optional schema, makes gemini answer with json that follows it.
 
     Returns:
         str: The generated response from the Gemini model.
     """
-    # The API endpoint for the gemini-2.5-flash-preview-05-20 model
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
+    key = response_cache_key("gemini", GEMINI_MODEL, prompt, params={"schema": response_schema} if response_schema else None)
+    if use_cache:
+        cached = await asyncio.to_thread(response_cache_get, key)
+        if cached is not None:
+            return cached
+
+    # The API endpoint for the gemini model
+    url = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:generateContent?key={api_key}"
 
     # The payload for the API request
     payload = {
@@ -65,34 +644,228 @@ def prompt_gemini(api_key: str, prompt: str) -> str:
             }
         ]
     }
+    if response_schema:
+        payload["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": response_schema
+        }
 
-    headers = {
-        "Content-Type": "application/json"
-    }
-
+    response_data = None
     try:
         # Make the POST request to the API
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-
-        # Parse the JSON response
-        response_data = response.json()
+        response_data = await _post_gemini(url, payload)
 
         # Extract the generated text from the response
         generated_text = response_data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "No text generated.")
 
+        # error strings never end up in the cache
+        if use_cache and not is_error_response(generated_text):
+            await asyncio.to_thread(response_cache_put, key, generated_text)
         return generated_text
 
-    except requests.exceptions.HTTPError as errh:
+    except httpx.HTTPStatusError as errh:
         return f"HTTP Error: {errh}"
-    except requests.exceptions.ConnectionError as errc:
+    except httpx.ConnectError as errc:
         return f"Error Connecting: {errc}"
-    except requests.exceptions.Timeout as errt:
+    except httpx.TimeoutException as errt:
         return f"Timeout Error: {errt}"
-    except requests.exceptions.RequestException as err:
+    except httpx.HTTPError as err:
+        return f"Something went wrong: {err}"
+    except CircuitOpenError as err:
         return f"Something went wrong: {err}"
-    except (IndexError, KeyError) as e:
-        return f"Error parsing response: {e}. Raw response: {response.text}"
+    except (IndexError, KeyError, ValueError) as e:
+        return f"Error parsing response: {e}. Raw response: {response_data}"
+
+
+def prompt_gemini(api_key: str, prompt: str, use_cache: bool = True, response_schema: dict = None) -> str:
+    """
+    Blocking version of prompt_gemini_async.
+    """
+    return run_sync(prompt_gemini_async(api_key, prompt, use_cache, response_schema))
+
+
+#----------------------- Structured output -----------------------#
+# how many times we ask for the same structured answer before giving up
+GENERATION_ATTEMPTS = max(1, int(config.get("Generation", {}).get("max_attempts", 3)))
+
+
+class ModelOutputError(RuntimeError):
+    """
+    The model didnt give us a usable answer (error response or invalid output) within the attempt budget.
+    """
+
+
+def _parse_structured(answer, schema, repair):
+    # (data, problems), problems is empty if the answer is usable
+    try:
+        with perf.stage("model.parse"):
+            data = schemas.parse_json(answer)
+            if repair:
+                data = repair(data)
+            return data, schemas.validate(data, schema)
+    except ValueError as e:
+        return None, [str(e)]
+
+
+def prompt_gemini_json(api_key, prompt, schema, repair=None, attempts=None, use_cache=True):
+    """
+    Asks gemini for json that follows schema and only returns it once it passes local validation.
+
+    Args:
+        api_key (str): Your Google AI Studio API key.
+        prompt (str): The text prompt to send to the model.
+        schema (dict): Schema from lib_schema_utilities, sent as responseSchema and checked locally.
+        repair (callable): Optional fixer for near-misses, gets the parsed data and returns the fixed data.
+        attempts (int): Max number of model calls, defaults to [Generation] max_attempts.
+        use_cache (bool): Set to False to always ask the model (a valid answer still gets stored).
+
+    Returns:
+        The parsed (and repaired) data.
+
+    Raises:
+        ModelOutputError: If no attempt gave valid data.
+    """
+    attempts = attempts or GENERATION_ATTEMPTS
+    key = response_cache_key("gemini", GEMINI_MODEL, prompt, params={"schema": schema})
+    # only validated answers are ever stored under this key, but entries from older versions may still be broken
+    if use_cache:
+        cached = response_cache_get(key)
+        if cached is not None:
+            data, problems = _parse_structured(cached, schema, repair)
+            if not problems:
+                return data
+            print(f"Cached structured answer invalid, asking again: {'; '.join(problems[:10])}")
+
+    problems = []
+    for attempt in range(attempts):
+        retry_prompt = prompt
+        if problems:
+            retry_prompt += "\n\nYour previous answer was invalid: " + "; ".join(problems[:10]) + ". Fix these problems."
+        # the raw answer never goes into the cache, it could be broken json
+        answer = prompt_gemini(api_key, retry_prompt, use_cache=False, response_schema=schema)
+        if is_error_response(answer):
+            problems = []
+            last_error = answer
+            print(f"Structured prompt attempt {attempt + 1}/{attempts} failed: {answer[:200]}")
+            continue
+        data, problems = _parse_structured(answer, schema, repair)
+        if not problems:
+            # stored under the original prompt (not the retry prompt) so the next call is free
+            response_cache_put(key, json.dumps(data, ensure_ascii=False))
+            return data
+        last_error = "; ".join(problems[:10])
+        print(f"Structured prompt attempt {attempt + 1}/{attempts} invalid: {last_error}")
+    raise ModelOutputError(f"No valid answer after {attempts} attempts: {last_error}")
+
+
+#----------------------- Streaming -----------------------#
+_STREAM_END = object()
+
+
+async def _stream_gemini(url, payload, put):
+    # runs on the io loop, hands every text chunk (then an exception or _STREAM_END) to put()
+    started = False
+    usage = {}
+
+    async def call():
+        nonlocal started
+        async with http_client().stream("POST", url, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[len("data:"):])
+                usage.update(data.get("usageMetadata", {}))
+                parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+                text = "".join(part.get("text", "") for part in parts)
+                if text:
+                    started = True
+                    put(text)
+
+    try:
+        # retrying is only safe as long as nothing reached the reader
+        await scheduled("gemini", call, tokens=estimate_tokens(payload), usage=lambda _: _gemini_usage({"usageMetadata": usage}),
+                        retry_on=lambda e: not started and _retryable(e), model=GEMINI_MODEL)
+    except Exception as e:
+        put(e)
+    finally:
+        put(_STREAM_END)
+
+
+def _stream_request(api_key, prompt):
+    url = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={api_key}"
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    return url, payload
+
+
+def prompt_gemini_stream(api_key, prompt, use_cache=True):
+    """
+    Like prompt_gemini, but yields the text in chunks while gemini is still generating.
+    Raises on errors instead of returning error strings. The full answer ends up in the
+    response cache, so a normal prompt_gemini call with the same prompt is free afterwards.
+    """
+    key = response_cache_key("gemini", GEMINI_MODEL, prompt)
+    if use_cache:
+        cached = response_cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(_stream_gemini(*_stream_request(api_key, prompt), chunks.put), _get_io_loop())
+    received = []
+    try:
+        while True:
+            item = chunks.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            received.append(item)
+            yield item
+    finally:
+        # the consumer went away (e.g. browser tab closed), stop paying for tokens nobody reads
+        if not future.done():
+            future.cancel()
+
+    if use_cache and received:
+        response_cache_put(key, "".join(received))
+
+
+async def prompt_gemini_stream_async(api_key, prompt, use_cache=True):
+    """
+    Async generator version of prompt_gemini_stream.
+    """
+    key = response_cache_key("gemini", GEMINI_MODEL, prompt)
+    if use_cache:
+        cached = await asyncio.to_thread(response_cache_get, key)
+        if cached is not None:
+            yield cached
+            return
+
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    def put(item):
+        loop.call_soon_threadsafe(chunks.put_nowait, item)
+
+    future = asyncio.run_coroutine_threadsafe(_stream_gemini(*_stream_request(api_key, prompt), put), _get_io_loop())
+    received = []
+    try:
+        while True:
+            item = await chunks.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            received.append(item)
+            yield item
+    finally:
+        if not future.done():
+            future.cancel()
+
+    if use_cache and received:
+        await asyncio.to_thread(response_cache_put, key, "".join(received))
 
 
 def get_mime_type(file_path):
@@ -109,21 +882,201 @@ def get_mime_type(file_path):
     return None
 
 
-def prompt_gemini_multimodal(prompt, files=None):
+# PDF extraction: pages with a real text layer are sent as text (a few KB),
+# only scanned / mostly-image pages get rasterized
+extraction_config = config.get("Extraction", {})
+MIN_PAGE_TEXT_CHARS = extraction_config.get("min_page_text_chars", 100)
+MAX_PAGE_IMAGE_COVERAGE = extraction_config.get("max_page_image_coverage", 0.5)
+
+
+def page_needs_image(page, text):
     """
-    Sends a multimodal prompt (text and files) to the Gemini API.
+    Returns True if a PDF page has (almost) no text layer or is mostly covered by images.
+    """
+    if len(text.strip()) < MIN_PAGE_TEXT_CHARS:
+        return True
+    page_area = abs(page.rect)
+    if not page_area:
+        return False
+    image_area = 0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info["bbox"]) & page.rect
+        image_area += abs(bbox)
+    return image_area / page_area > MAX_PAGE_IMAGE_COVERAGE
+
+
+#----------------------- Page rendering -----------------------#
+# pages that have to go out as images are rendered on a process pool and cached on disk,
+# keyed by (file hash, page, dpi, format), so re-running extract doesnt render them again
+RENDER_DPI = extraction_config.get("render_dpi", 110)
+RENDER_FORMAT = extraction_config.get("render_format", "jpeg")     # "jpeg" or "png"
+RENDER_JPEG_QUALITY = extraction_config.get("render_jpeg_quality", 80)
+RENDER_WORKERS = extraction_config.get("render_workers", 0)         # 0 = one per cpu core
+PAGE_CACHE_DIR = extraction_config.get("page_cache_dir", "page_cache")
+PAGE_CACHE_MAX_MB = extraction_config.get("page_cache_max_mb", 1000)
+_page_cache_budget = DiskBudget(PAGE_CACHE_DIR, PAGE_CACHE_MAX_MB * 1024 * 1024, name="page-cache")
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def file_hash(file_path):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _get_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn, because we get called from threads of the web app
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _render_pool
+
+
+def render_pdf_pages(file_path, page_numbers, dpi=None, fmt=None, quality=None):
+    """
+    Renders PDF pages to images, using the disk cache where possible and the process pool for the rest.
 
     Args:
-        prompt (str): The text prompt for the model.
-        files (list): A list of file paths (images or PDFs) to include.
-    
+        file_path (str): Path to the PDF.
+        page_numbers (list): 0-based page numbers.
+        dpi (int): Render resolution.
+        fmt (str): "jpeg" or "png".
+        quality (int): JPEG quality.
+
     Returns:
-        dict: The JSON response from the API.
+        tuple: (mime type, [image bytes in the order of page_numbers])
     """
-    api_key = google_ai_studio_key 
+    dpi = dpi or RENDER_DPI
+    fmt = fmt or RENDER_FORMAT
+    quality = quality or RENDER_JPEG_QUALITY
+    ext = "jpg" if fmt == "jpeg" else "png"
+    mime_type = "image/jpeg" if fmt == "jpeg" else "image/png"
+    variant = f"{dpi}dpi_q{quality}.{ext}" if fmt == "jpeg" else f"{dpi}dpi.{ext}"
+
+    cache_folder = os.path.join(PAGE_CACHE_DIR, file_hash(file_path))
+    cache_paths = [os.path.join(cache_folder, f"{n}_{variant}") for n in page_numbers]
+
+    images = {}
+    missing = []
+    for n, path in zip(page_numbers, cache_paths):
+        try:
+            with open(path, "rb") as f:
+                images[n] = f.read()
+            _page_cache_budget.touch(path)   # mtime = last used, for the eviction
+        except FileNotFoundError:
+            missing.append(n)
+
+    if missing:
+        print(f"Rendering {len(missing)} pages of {file_path} ({len(page_numbers) - len(missing)} cached)")
+        if len(missing) == 1:
+            batches = [missing]
+            rendered = [render.render_pages(file_path, missing, dpi, fmt, quality)]
+        else:
+            pool = _get_render_pool()
+            workers = RENDER_WORKERS or os.cpu_count()
+            batches = [missing[i::workers] for i in range(workers) if missing[i::workers]]
+            # lib_render_utilities is what the pool processes import, not this module (and its clients)
+            futures = [pool.submit(render.render_pages, file_path, batch, dpi, fmt, quality) for batch in batches]
+            rendered = [future.result() for future in futures]
 
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
+        os.makedirs(cache_folder, exist_ok=True)
+        for batch, batch_images in zip(batches, rendered):
+            for n, data in zip(batch, batch_images):
+                images[n] = data
+                path = os.path.join(cache_folder, f"{n}_{variant}")
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                _page_cache_budget.added(len(data))
 
+    return mime_type, [images[n] for n in page_numbers]
+
+
+def pdf_page_batches(file_path, batch_pages):
+    """
+    Splits a PDF into page ranges of at most batch_pages pages. Anything that isnt a PDF is one batch (None).
+    """
+    if get_mime_type(file_path) != 'application/pdf' or not batch_pages:
+        return [None]
+    doc = fitz.open(file_path)
+    page_count = doc.page_count
+    doc.close()
+    return [range(start, min(start + batch_pages, page_count)) for start in range(0, page_count, batch_pages)] or [None]
+
+
+def extract_pdf_parts(file_path, pages=None):
+    """
+    Turns a PDF into Gemini request parts: consecutive text pages are merged into one text part
+    (with page markers so the model keeps the structure), image pages become inline images.
+
+    Args:
+        file_path (str): Path to the PDF.
+        pages (range): Only these (0-based) pages, default is all of them.
+
+    Returns:
+        list: Parts for the "contents" of a generateContent request.
+    """
+    name = os.path.basename(file_path)
+
+    # first pass: text layer for every page (cheap), remember which pages need an image
+    page_texts = []
+    with perf.stage("pdf.text_layer"):
+        doc = fitz.open(file_path)
+        try:
+            for page in doc:
+                if pages is not None and page.number not in pages:
+                    continue
+                text = page.get_text("text", sort=True)
+                page_texts.append((page.number, None if page_needs_image(page, text) else text.strip()))
+        finally:
+            doc.close()
+
+    image_pages = [n for n, text in page_texts if text is None]
+    images = {}
+    if image_pages:
+        with perf.stage("pdf.render"):
+            mime_type, rendered = render_pdf_pages(file_path, image_pages)
+        with perf.stage("pdf.base64"):
+            images = {n: base64.b64encode(image).decode('utf-8') for n, image in zip(image_pages, rendered)}
+
+    # second pass: build the parts in page order
+    parts = []
+    text_pages = []
+
+    def flush_text():
+        if text_pages:
+            parts.append({"text": "\n\n".join(text_pages)})
+            text_pages.clear()
+
+    for n, text in page_texts:
+        if text is None:
+            flush_text()
+            parts.append({"text": f"[{name}, page {n + 1}]"})
+            parts.append({
+                "inlineData": {
+                    "mimeType": mime_type,
+                    "data": images[n]
+                }
+            })
+        else:
+            text_pages.append(f"[{name}, page {n + 1}]\n{text}")
+    flush_text()
+    return parts
+
+
+def build_multimodal_parts(prompt, files=None, pages=None):
+    """
+    Builds the request parts for a prompt plus files (images or PDFs).
+    """
     parts = [{"text": prompt}]
 
     if files:
@@ -136,22 +1089,8 @@ def prompt_gemini_multimodal(prompt, files=None):
             # For PDFs, you must first extract the content
             if mime_type == 'application/pdf' and fitz:
                 print(f"Processing PDF: {file_path}")
-                pdf_parts = []
                 try:
-                    doc = fitz.open(file_path)
-                    for page_num in range(min(10, doc.page_count)):  # Process up to 10 pages to avoid large payloads
-                        page = doc.load_page(page_num)
-                        pix = page.get_pixmap()
-                        img_data = pix.tobytes("png")
-                        base64_img = base64.b64encode(img_data).decode('utf-8')
-                        pdf_parts.append({
-                            "inlineData": {
-                                "mimeType": "image/png",
-                                "data": base64_img
-                            }
-                        })
-                    doc.close()
-                    parts.extend(pdf_parts)
+                    parts.extend(extract_pdf_parts(file_path, pages))
                 except Exception as e:
                     print(f"Error processing PDF file {file_path}: {e}")
                     continue
@@ -175,27 +1114,70 @@ def prompt_gemini_multimodal(prompt, files=None):
             else:
                 print(f"Unsupported MIME type: {mime_type}")
                 continue
+    return parts
+
 
+async def prompt_gemini_multimodal_async(prompt, files=None, pages=None, use_cache=True):
+    """
+    Sends a multimodal prompt (text and files) to the Gemini API.
+
+    Args:
+        prompt (str): The text prompt for the model.
+        files (list): A list of file paths (images or PDFs) to include.
+        pages (range): Only send these (0-based) pages of the PDFs.
+        use_cache (bool): Set to False to always ask the model (and not store the answer).
+    
+    Returns:
+        dict: The JSON response from the API.
+    """
+    api_key = google_ai_studio_key 
+
+    existing = [f for f in files or [] if os.path.isfile(f)]
+    params = {
+        "pages": [pages.start, pages.stop] if pages is not None else None,
+        # these change what we actually send for a pdf
+        "extraction": [MIN_PAGE_TEXT_CHARS, MAX_PAGE_IMAGE_COVERAGE, RENDER_DPI, RENDER_FORMAT, RENDER_JPEG_QUALITY]
+    }
+    # hashing files and rendering pages is blocking work, keep it off the event loop
+    key = await asyncio.to_thread(response_cache_key, "gemini", GEMINI_MODEL, prompt, existing, params)
+    if use_cache:
+        cached = await asyncio.to_thread(response_cache_get, key)
+        if cached is not None:
+            return json.loads(cached)
+
+    api_url = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:generateContent?key={api_key}"
+
+    parts = await asyncio.to_thread(build_multimodal_parts, prompt, files, pages)
     payload = {
         "contents": [{"parts": parts}]
     }
 
     try:
-        response = requests.post(api_url, json=payload)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        result = await _post_gemini(api_url, payload)
+        if use_cache and result.get("candidates"):
+            await asyncio.to_thread(response_cache_put, key, json.dumps(result))
+        return result
+    except (httpx.HTTPError, CircuitOpenError, ValueError) as e:
         print(f"An error occurred: {e}")
         return None
-def generate_image(prompt, max_retries=5, initial_delay=1):
+
+
+def prompt_gemini_multimodal(prompt, files=None, pages=None, use_cache=True):
+    """
+    Blocking version of prompt_gemini_multimodal_async.
+    """
+    return run_sync(prompt_gemini_multimodal_async(prompt, files, pages, use_cache))
+
+
+async def generate_image_async(prompt, max_retries=None, initial_delay=None):
     """
     Generates an image using the gemini-2.5-flash-image-preview model via the Gemini API.
-    Includes an exponential backoff strategy for handling 429 RESOURCE_EXHAUSTED errors.
+    429 RESOURCE_EXHAUSTED errors are retried with backoff by the scheduler ("gemini-image" limits).
 
     Args:
         prompt (str): The text prompt to guide the image generation.
-        max_retries (int): The maximum number of times to retry the request.
-        initial_delay (int): The initial delay in seconds before the first retry.
+        max_retries (int): Retries for rate limits / server errors, defaults to the scheduler setting.
+        initial_delay (float): Delay in seconds before the first retry, defaults to [Scheduler] backoff_base_seconds.
 
     Returns:
         tuple: A tuple containing the base64-encoded image data (str) and
@@ -203,7 +1185,7 @@ def generate_image(prompt, max_retries=5, initial_delay=1):
     """
     api_key = google_ai_studio_key 
 
-    api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
+    api_url = f"{GEMINI_BASE_URL}/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
     
     payload = {
         "contents": [
@@ -224,37 +1206,68 @@ def generate_image(prompt, max_retries=5, initial_delay=1):
         "key": api_key
     }
 
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = requests.post(api_url, json=payload)
-            
-            # Check for a 429 error specifically
-            if response.status_code == 429:
-                delay = initial_delay * (2 ** retries)
-                print(f"Rate limit exceeded. Retrying in {delay} seconds...")
-                time.sleep(delay)
-                retries += 1
-                continue
-            
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            candidates = result.get("candidates", [])
-            if candidates and len(candidates) > 0:
-                candidate = candidates[0]
-                parts = candidate.get("content", {}).get("parts", [])
-                for part in parts:
-                    if "inlineData" in part:
-                        inline_data = part["inlineData"]
-                        return inline_data.get("data"), inline_data.get("mimeType")
-            
-            return None, None
+    try:
+        result = await _post_gemini(api_url, payload, provider="gemini-image", retries=max_retries, backoff_base=initial_delay)
+    except (httpx.HTTPError, CircuitOpenError, ValueError) as e:
+        print(f"An error occurred during the API call: {e}")
+        return None, None
+
+    candidates = result.get("candidates", [])
+    if candidates and len(candidates) > 0:
+        candidate = candidates[0]
+        parts = candidate.get("content", {}).get("parts", [])
+        for part in parts:
+            if "inlineData" in part:
+                inline_data = part["inlineData"]
+                return inline_data.get("data"), inline_data.get("mimeType")
 
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred during the API call: {e}")
-            return None, None
-    
     return None, None
 
+
+def generate_image(prompt, max_retries=None, initial_delay=None):
+    """
+    Blocking version of generate_image_async.
+    """
+    return run_sync(generate_image_async(prompt, max_retries, initial_delay))
+
+
+#----------------------- Batches -----------------------#
+BATCH_CONCURRENCY = http_config.get("batch_concurrency", 8)
+
+
+async def prompt_batch_async(prompts, provider="gemini", model=None, concurrency=None, use_cache=True):
+    """
+    Runs many text prompts at once (at most `concurrency` in flight) and returns the results in the same order.
+
+    Args:
+        prompts (list): The prompts.
+        provider (str): "gemini" or "openai".
+        model (str): Model for openai (gemini always uses GEMINI_MODEL).
+        concurrency (int): Max requests at the same time, defaults to batch_concurrency in config.toml.
+
+    Returns:
+        list: One dict per prompt: {"text": str or None, "error": str or None}
+    """
+    semaphore = asyncio.Semaphore(concurrency or BATCH_CONCURRENCY)
+
+    async def run_one(prompt):
+        async with semaphore:
+            try:
+                if provider == "openai":
+                    text = await prompt_chat_gpt_async(model, prompt, use_cache)
+                else:
+                    text = await prompt_gemini_async(google_ai_studio_key, prompt, use_cache)
+            except Exception as e:
+                return {"text": None, "error": str(e)}
+        if is_error_response(text):
+            return {"text": None, "error": text}
+        return {"text": text, "error": None}
+
+    return await asyncio.gather(*(run_one(prompt) for prompt in prompts))
+
+
+def prompt_batch(prompts, provider="gemini", model=None, concurrency=None, use_cache=True):
+    """
+    Blocking version of prompt_batch_async.
+    """
+    return run_sync(prompt_batch_async(prompts, provider, model, concurrency, use_cache))
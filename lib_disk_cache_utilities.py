@@ -0,0 +1,93 @@
+import os
+import threading
+
+# size limit for the file caches (tts clips, rendered pdf pages). the mtime of a file doubles as
+# "last used" (touch() it on a hit), files with the same name but another extension
+# (clip.mp3 + clip.json) are one entry and get deleted together.
+
+# evicting goes down to this share of the limit, so not every put after reaching it starts a scan
+LOW_WATERMARK = 0.9
+
+
+class DiskBudget:
+    def __init__(self, directory, max_bytes, name="cache"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.name = name
+        self.lock = threading.Lock()
+        self.total = None       # bytes in the folder as far as this process knows, None until the first scan
+        self.evicting = False
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, size):
+        """
+        Counts size new bytes and, if that puts the folder over the limit, evicts on a background
+        thread. Cheap enough to call from the event loop.
+        """
+        with self.lock:
+            if self.total is not None:
+                self.total += size
+                if self.total <= self.max_bytes:
+                    return
+            if self.evicting:
+                return
+            self.evicting = True
+        threading.Thread(target=self._evict, name=f"{self.name}-evict", daemon=True).start()
+
+    def _scan(self):
+        entries = {}    # path without extension -> [last used, size]
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                # files that are still being written
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entry = entries.setdefault(os.path.splitext(path)[0], [0.0, 0])
+                entry[0] = max(entry[0], st.st_mtime)
+                entry[1] += st.st_size
+        return entries
+
+    def _evict(self):
+        with self.lock:
+            before = self.total
+        remaining = 0
+        try:
+            entries = self._scan()
+            remaining = sum(size for _, size in entries.values())
+            if remaining > self.max_bytes:
+                target = self.max_bytes * LOW_WATERMARK
+                # least recently used first
+                for stem, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+                    folder, base = os.path.split(stem)
+                    try:
+                        for name in os.listdir(folder):
+                            if os.path.splitext(name)[0] == base and not name.endswith(".tmp"):
+                                os.remove(os.path.join(folder, name))
+                    except OSError:
+                        pass
+                    remaining -= size
+                    if remaining <= target:
+                        break
+                self._remove_empty_folders()
+        finally:
+            with self.lock:
+                # puts that happened while we were scanning are not in the scan (or maybe they are, close enough)
+                self.total = remaining + (self.total - before if before is not None and self.total is not None else 0)
+                self.evicting = False
+
+    def _remove_empty_folders(self):
+        for root, dirs, files in os.walk(self.directory, topdown=False):
+            if root != self.directory and not dirs and not files:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
@@ -0,0 +1,268 @@
+import os
+import subprocess
+import threading
+import functools
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import imageio_ffmpeg
+from moviepy.editor import VideoFileClip, CompositeVideoClip, ImageClip
+from moviepy.video.fx.all import loop
+from PIL import Image, ImageDraw, ImageFont
+
+# captions and segment encoding. the encode pool's processes import this module, so it has to stay
+# light: no whisper/torch, no model clients, nothing that starts threads at import time.
+
+# setup
+import tomllib
+# Read the TOML file
+with open("config.toml", "rb") as f:   # Must be opened in binary mode
+    config = tomllib.load(f)
+
+video_config = config.get("Video", {})
+
+
+#----------------------- Captions -----------------------#
+# captions are drawn with PIL in-process instead of TextClip (which starts ImageMagick for every single chunk)
+# and the same caption text is only ever rasterized once
+CAPTION_FONTS = [video_config.get("caption_font", "arialbd.ttf"), "Arial Bold.ttf", "DejaVuSans-Bold.ttf"]
+# caption chunks rarely repeat between videos, the cache is mostly for retries and re-renders of the same script
+CAPTION_CACHE_MB = video_config.get("caption_cache_mb", 64)
+
+
+class _CaptionCache:
+    # LRU limited by the bytes of the cached arrays, not by the number of captions
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items or value.nbytes > self.max_bytes:
+                return
+            self.items[key] = value
+            self.bytes += value.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def summary(self):
+        with self.lock:
+            return f"{self.hits} hits, {self.misses} misses, {len(self.items)} cached ({self.bytes / 1e6:.1f} MB)"
+
+
+caption_cache = _CaptionCache(CAPTION_CACHE_MB * 1024 * 1024)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_caption_font(size):
+    for font in CAPTION_FONTS:
+        try:
+            return ImageFont.truetype(font, size)
+        except OSError:
+            continue
+    print("No caption font found, using PIL's default font")
+    return ImageFont.load_default(size)
+
+
+def _wrap_caption(text, font, max_width):
+    lines = []
+    current = ""
+    for word in text.split():
+        candidate = f"{current} {word}".strip()
+        if current and font.getlength(candidate) > max_width:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        lines.append(current)
+    return "\n".join(lines)
+
+
+def render_caption(text, fontsize=80, color="white", stroke_color="red", stroke_width=4, width=800):
+    """
+    Rasterizes a caption wrapped to the given width and cropped to the text.
+
+    Returns:
+        numpy.ndarray: uint8 RGBA array (read only, it is shared through the cache).
+    """
+    key = (text, fontsize, color, stroke_color, stroke_width, width)
+    rgba = caption_cache.get(key)
+    if rgba is None:
+        rgba = _rasterize_caption(*key)
+        caption_cache.put(key, rgba)
+    return rgba
+
+
+def _rasterize_caption(text, fontsize, color, stroke_color, stroke_width, width):
+    font = _load_caption_font(fontsize)
+    wrapped = _wrap_caption(text, font, width - 2 * stroke_width)
+
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox(
+        (width / 2, 0), wrapped, font=font, anchor="ma", align="center", stroke_width=stroke_width
+    )
+    height = max(1, int(bottom - top) + 1)
+
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    ImageDraw.Draw(image).multiline_text(
+        (width / 2, -top), wrapped, font=font, fill=color, anchor="ma", align="center",
+        stroke_width=stroke_width, stroke_fill=stroke_color
+    )
+    # the clip gets centered on the video anyway, the empty space left and right of the text is just memory
+    crop_left = max(0, int(left))
+    crop_right = min(width, int(right) + 1)
+    rgba = np.ascontiguousarray(np.asarray(image)[:, crop_left:max(crop_right, crop_left + 1)])
+    # shared between clips, nobody is allowed to draw on it
+    rgba.flags.writeable = False
+    return rgba
+
+
+def create_subtitle_clips(subtitle_segments, video_width):
+    clips = []
+    for start_time, end_time, txt in subtitle_segments:
+        rgba = render_caption(
+            txt,
+            fontsize=80,
+            color='white',
+            stroke_color='red',
+            stroke_width=4,
+            width=int(video_width * 0.8)     # wrap text to 80% of video width
+        )
+        clip = (
+            ImageClip(rgba[:, :, :3])
+            .set_mask(ImageClip(rgba[:, :, 3] / 255.0, ismask=True))
+            .set_position(('center', 'center'))
+            .set_start(start_time)
+            .set_end(end_time)
+        )
+        clips.append(clip)
+    return clips
+
+
+#----------------------- Background videos -----------------------#
+def open_background(path, start, end):
+    """
+    Opens the background for [start, end], looping it if the audio is longer than the video.
+    """
+    clip = VideoFileClip(path, audio=False)
+    if clip.duration < end:
+        clip = loop(clip, duration=end)
+    return clip.subclip(start, end)
+
+
+#----------------------- Encoding -----------------------#
+# encode_workers = 1 renders the whole video in one go like before, anything else splits the timeline
+# into segments that are rendered by a process pool and glued back together without re-encoding
+ENCODE_WORKERS = video_config.get("encode_workers", 1)                 # 0 = one per cpu core
+ENCODE_SEGMENT_SECONDS = video_config.get("encode_segment_seconds", 60)
+
+# one pool for all renders: with video_workers renders at once their segments share these processes
+# instead of every render starting ENCODE_WORKERS new ones
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+
+def _get_encode_pool(workers):
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            # spawn instead of fork, we are usually running inside a thread of the web app
+            _encode_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _encode_pool
+
+
+def plan_segments(duration, boundaries, fps, segment_seconds=None):
+    """
+    Splits [0, duration] into ranges of at least segment_seconds, cutting only at the given
+    boundaries (line starts), snapped to frame times.
+
+    Returns:
+        list: [(start, end), ...]
+    """
+    segment_seconds = segment_seconds or ENCODE_SEGMENT_SECONDS
+    cuts = [0.0]
+    for t in sorted(boundaries):
+        t = round(t * fps) / fps
+        # the last segment shouldnt end up tiny either
+        if t - cuts[-1] >= segment_seconds and duration - t >= segment_seconds / 2:
+            cuts.append(t)
+    cuts.append(duration)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _encode_segment(background_path, start, end, subtitle_segments, output_path):
+    # runs in a worker process, so it opens its own clips
+    video = open_background(background_path, start, end)
+    # only the captions that overlap this range, moved to segment time
+    segments = [
+        (max(s, start) - start, min(e, end) - start, txt)
+        for s, e, txt in subtitle_segments
+        if e > start and s < end
+    ]
+    final_video = CompositeVideoClip([video, *create_subtitle_clips(segments, video.w)])
+    final_video.write_videofile(output_path, codec="libx264", audio=False, logger=None)
+    final_video.close()
+    video.close()
+    return output_path
+
+
+def encode_video_parallel(background_path, audio_path, duration, subtitle_segments, boundaries, output_path, scratch_dir,
+                          workers=None, segment_seconds=None):
+    """
+    Renders the video in segments on a process pool, concatenates them losslessly and muxes the
+    full audio track in once at the end (so there are no audio glitches at the cuts).
+    """
+    workers = workers or ENCODE_WORKERS or os.cpu_count()
+
+    background = VideoFileClip(background_path)
+    fps = background.fps
+    background.close()
+
+    ranges = plan_segments(duration, boundaries, fps, segment_seconds)
+    os.makedirs(scratch_dir, exist_ok=True)
+    print(f"Encoding {len(ranges)} segments on the shared pool ({workers} workers)...")
+
+    pool = _get_encode_pool(workers)
+    futures = [
+        pool.submit(_encode_segment, background_path, start, end, subtitle_segments,
+                    os.path.join(scratch_dir, f"segment_{i}.mp4"))
+        for i, (start, end) in enumerate(ranges)
+    ]
+    parts = [future.result() for future in futures]
+
+    list_path = os.path.join(scratch_dir, "segments.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for part in parts:
+            f.write(f"file '{os.path.abspath(part)}'\n")
+
+    subprocess.run([
+        imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "concat", "-safe", "0", "-i", list_path,
+        "-i", audio_path,
+        "-map", "0:v", "-map", "1:a",
+        "-c:v", "copy", "-c:a", "aac",
+        "-shortest", output_path
+    ], check=True)
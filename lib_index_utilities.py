@@ -0,0 +1,165 @@
+import json
+import os
+import re
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# BM25 parameters (the usual defaults)
+K1 = 1.5
+B = 0.75
+
+# sections longer than this get split at paragraphs
+MAX_CHUNK_CHARS = 2000
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_encoding = None
+
+
+def tokenize(text):
+    return _WORD_RE.findall(text.lower())
+
+
+def count_tokens(text):
+    """
+    Counts model tokens with tiktoken, or estimates them (~4 chars per token) if it isnt available.
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # tiktoken downloads the encoding on first use, no internet = no tiktoken
+            print(f"tiktoken unavailable, estimating token counts: {e}")
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def chunk_analysis(text, max_chars=MAX_CHUNK_CHARS):
+    """
+    Splits the analysis into sections at markdown headings, and long sections into paragraphs.
+    The heading of a section is repeated in front of each of its paragraphs so every chunk makes sense alone.
+    """
+    sections = []
+    current = []
+    for line in text.splitlines():
+        # a heading starts a new section, unless the current one is only headings so far ("# file.pdf" + "## Intro")
+        has_body = any(l.strip() and not l.lstrip().startswith("#") for l in current)
+        if line.lstrip().startswith("#") and has_body:
+            sections.append("\n".join(current).strip())
+            current = []
+        current.append(line)
+    if current:
+        sections.append("\n".join(current).strip())
+
+    chunks = []
+    for section in sections:
+        if not section:
+            continue
+        if len(section) <= max_chars:
+            chunks.append(section)
+            continue
+        first_line = section.splitlines()[0]
+        heading = first_line if first_line.lstrip().startswith("#") else ""
+        body = section[len(heading):] if heading else section
+        piece = ""
+        for paragraph in re.split(r"\n\s*\n", body):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if piece and len(piece) + len(paragraph) > max_chars:
+                chunks.append(f"{heading}\n{piece}".strip())
+                piece = ""
+            piece = f"{piece}\n\n{paragraph}" if piece else paragraph
+        if piece:
+            chunks.append(f"{heading}\n{piece}".strip())
+    return chunks
+
+
+def build_index(analysis_text, index_path):
+    """
+    Chunks the analysis and writes a BM25 index for it to index_path (json).
+    Postings are stored per term (term -> docs + term frequencies) so a query only touches its own terms.
+    """
+    chunks = chunk_analysis(analysis_text)
+
+    postings = {}
+    doc_lengths = []
+    for doc_id, chunk in enumerate(chunks):
+        tokens = tokenize(chunk)
+        doc_lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            postings.setdefault(token, ([], []))
+            postings[token][0].append(doc_id)
+            postings[token][1].append(tf)
+
+    index = {
+        "chunks": chunks,
+        "doc_lengths": doc_lengths,
+        "postings": postings
+    }
+    tmp = index_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, index_path)
+    return index
+
+
+def load_index(index_path):
+    with open(index_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def search(index, query, top_k=8):
+    """
+    Returns the ids of the top_k chunks for the query, best first.
+    """
+    chunks = index["chunks"]
+    if not chunks:
+        return []
+    doc_lengths = np.asarray(index["doc_lengths"], dtype=np.float64)
+    avg_length = doc_lengths.mean() or 1.0
+    n_docs = len(chunks)
+
+    scores = np.zeros(n_docs)
+    for term in set(tokenize(query)):
+        posting = index["postings"].get(term)
+        if not posting:
+            continue
+        doc_ids = np.asarray(posting[0])
+        tf = np.asarray(posting[1], dtype=np.float64)
+        df = len(doc_ids)
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        norm = K1 * (1 - B + B * doc_lengths[doc_ids] / avg_length)
+        scores[doc_ids] += idf * tf * (K1 + 1) / (tf + norm)
+
+    ranked = np.argsort(-scores, kind="stable")[:top_k]
+    return [int(i) for i in ranked if scores[i] > 0]
+
+
+def select_context(index, query, top_k=8, token_budget=6000):
+    """
+    Picks the most relevant chunks for the query that fit into token_budget and
+    returns them in their original order (so the text still reads like the analysis).
+    If nothing matches, the beginning of the analysis is used instead.
+    """
+    ranked = search(index, query, top_k) or list(range(min(top_k, len(index["chunks"]))))
+
+    picked = []
+    used = 0
+    for doc_id in ranked:
+        tokens = count_tokens(index["chunks"][doc_id])
+        if used + tokens > token_budget:
+            continue
+        picked.append(doc_id)
+        used += tokens
+    return "\n\n".join(index["chunks"][doc_id] for doc_id in sorted(picked))
@@ -0,0 +1,294 @@
+import os
+import socket
+import sqlite3
+import threading
+import json
+import time
+import traceback
+from contextlib import nullcontext
+
+import lib_metrics_utilities as metrics
+
+# jobs live in the same sqlite file as everything else so a restart doesnt eat the queue
+DATABASE = "users.db"
+
+# how long an idle worker sleeps before looking at the table again (submit() wakes it up earlier)
+POLL_INTERVAL = 2.0
+
+# a claimed job belongs to its process for LEASE_SECONDS, the process renews the lease while the job runs.
+# only jobs whose lease ran out (the process died) are picked up again, by anyone
+LEASE_SECONDS = 60
+# a job that killed its process this many times is given up on instead of being retried forever
+MAX_ATTEMPTS = 3
+
+_handlers = {}      # kind -> (func, queue)
+_wakeups = {}       # queue -> threading.Event
+_threads = []
+_start_lock = threading.Lock()
+_table_ready = False
+
+
+def _owner():
+    # computed every time, a forked process must not renew its parent's leases
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _connect():
+    # the web process may submit jobs without ever calling start() (flask run + a separate worker),
+    # so the table (and its migrations) are made on first use in every process
+    if not _table_ready:
+        init_jobs_table()
+    return _open()
+
+
+def _open():
+    # autocommit mode, we open the transactions ourselves when we need them
+    db = sqlite3.connect(DATABASE, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def init_jobs_table():
+    global _table_ready
+    db = _open()
+    try:
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                queue TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                args TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                result_url TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                owner TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+        # tables from before the leases
+        columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("max_attempts", "INTEGER NOT NULL DEFAULT 3"), ("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status_queue ON jobs (status, queue, id)")
+    finally:
+        db.close()
+    _table_ready = True
+
+
+def register(kind, func, queue="default"):
+    """
+    Registers a handler for a job kind.
+
+    Args:
+        kind (str): Name stored in the jobs table (e.g. "video").
+        func (callable): Called with the stored args as keyword arguments, returns the result url.
+        queue (str): Worker pool the job runs on, so slow renders dont block quick notes.
+    """
+    _handlers[kind] = (func, queue)
+    _wakeups.setdefault(queue, threading.Event())
+
+
+def submit(kind, owner_id, **args):
+    """
+    Puts a job into the table and returns its id right away.
+    If the exact same job is already queued or running we just hand back that one
+    (students love double clicking the video button).
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    _, queue = _handlers[kind]
+    args_json = json.dumps(args, sort_keys=True)
+
+    db = _connect()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        existing = db.execute(
+            "SELECT id FROM jobs WHERE kind=? AND args=? AND status IN ('queued', 'running')",
+            (kind, args_json)
+        ).fetchone()
+        if existing:
+            db.execute("COMMIT")
+            return existing["id"]
+        cur = db.execute(
+            "INSERT INTO jobs (kind, queue, user_id, args, status, max_attempts, created_at) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (kind, queue, owner_id, args_json, MAX_ATTEMPTS, time.time())
+        )
+        db.execute("COMMIT")
+        job_id = cur.lastrowid
+    finally:
+        db.close()
+
+    _wakeups[queue].set()
+    return job_id
+
+
+def get_job(job_id):
+    """
+    Returns the job as a dict (status is one of queued/running/done/failed) or None.
+    """
+    db = _connect()
+    try:
+        row = db.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+    finally:
+        db.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job["args"] = json.loads(job["args"])
+    return job
+
+
+def counts():
+    """
+    Returns {(queue, status): number of jobs} for the queued and running jobs.
+    """
+    db = _connect()
+    try:
+        rows = db.execute(
+            "SELECT queue, status, COUNT(*) AS n FROM jobs WHERE status IN ('queued', 'running') GROUP BY queue, status"
+        ).fetchall()
+    finally:
+        db.close()
+    return {(row["queue"], row["status"]): row["n"] for row in rows}
+
+
+def _collect_metrics():
+    found = counts()
+    # every known queue shows up with 0 too, a series that disappears is hard to alert on
+    queues = sorted(set(_wakeups) | {queue for queue, _ in found})
+    samples = [({"queue": queue, "status": status}, found.get((queue, status), 0))
+               for queue in queues for status in ("queued", "running")]
+    return [("jobs", "gauge", "Jobs waiting or running per worker queue", samples)]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def _claim(queue):
+    now = time.time()
+    db = _connect()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        # the process running these died on every attempt, dont let the next one die on it too
+        db.execute(
+            """
+            UPDATE jobs SET status='failed', error='worker died ' || attempts || ' times while running this job', finished_at=?
+            WHERE status='running' AND queue=? AND lease_until < ? AND attempts >= max_attempts
+            """,
+            (now, queue, now)
+        )
+        row = db.execute(
+            """
+            SELECT * FROM jobs WHERE queue=? AND (status='queued' OR (status='running' AND lease_until < ?))
+            ORDER BY id LIMIT 1
+            """,
+            (queue, now)
+        ).fetchone()
+        if row is None:
+            db.execute("COMMIT")
+            return None
+        if row["status"] == "running":
+            print(f"[jobs] lease of job {row['id']} ran out (owner {row['owner']}), taking it over")
+        db.execute(
+            "UPDATE jobs SET status='running', owner=?, lease_until=?, started_at=?, attempts=attempts+1 WHERE id=?",
+            (_owner(), now + LEASE_SECONDS, now, row["id"])
+        )
+        db.execute("COMMIT")
+        return dict(row)
+    finally:
+        db.close()
+
+
+def _renew_leases():
+    # one thread per process keeps the leases of all jobs this process is running alive
+    while True:
+        time.sleep(LEASE_SECONDS / 3)
+        try:
+            db = _connect()
+            try:
+                db.execute("UPDATE jobs SET lease_until=? WHERE status='running' AND owner=?",
+                           (time.time() + LEASE_SECONDS, _owner()))
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print(f"[jobs] could not renew leases: {e}")
+
+
+def _finish(job_id, status, result_url=None, error=None):
+    db = _connect()
+    try:
+        # owner check: if our lease ran out and someone else took the job over, the result is theirs to write
+        db.execute(
+            "UPDATE jobs SET status=?, result_url=?, error=?, finished_at=?, lease_until=NULL WHERE id=? AND owner=?",
+            (status, result_url, error, time.time(), job_id, _owner())
+        )
+    finally:
+        db.close()
+
+
+def _run(job, context):
+    func, _ = _handlers[job["kind"]]
+    args = json.loads(job["args"])
+    print(f"[jobs] running job {job['id']} ({job['kind']})")
+    try:
+        with context():
+            url = func(**args)
+        _finish(job["id"], "done", result_url=url)
+        print(f"[jobs] job {job['id']} done")
+    except Exception as e:
+        traceback.print_exc()
+        _finish(job["id"], "failed", error=str(e))
+
+
+def _worker(queue, context):
+    wakeup = _wakeups[queue]
+    while True:
+        wakeup.clear()
+        try:
+            job = _claim(queue)
+        except sqlite3.Error as e:
+            print(f"[jobs] could not claim a job on '{queue}': {e}")
+            job = None
+        if job is None:
+            wakeup.wait(POLL_INTERVAL)
+            continue
+        _run(job, context)
+
+
+def start(workers, context=None):
+    """
+    Starts the worker threads of this process. Call it from the entry point (not at import time),
+    every process that calls it works on the same table. Jobs of a process that died are
+    picked up again once their lease runs out.
+
+    Args:
+        workers (dict): queue name -> number of worker threads.
+        context (callable): Returns a context manager each job runs inside (e.g. a flask request context for url_for).
+    """
+    with _start_lock:
+        if _threads:
+            return
+        init_jobs_table()
+
+        # every registered queue gets at least one worker, otherwise its jobs would sit there forever
+        workers = {**{queue: 1 for queue in _wakeups}, **workers}
+        context = context or nullcontext
+        for queue, count in workers.items():
+            _wakeups.setdefault(queue, threading.Event())
+            for i in range(int(count)):
+                t = threading.Thread(target=_worker, args=(queue, context), name=f"jobs-{queue}-{i}", daemon=True)
+                t.start()
+                _threads.append(t)
+        t = threading.Thread(target=_renew_leases, name="jobs-leases", daemon=True)
+        t.start()
+        _threads.append(t)
+        print(f"[jobs] started workers: {workers}")
@@ -0,0 +1,225 @@
+import bisect
+import hmac
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lib_perf_utilities as perf
+
+# tiny prometheus style metrics (counters, gauges, histograms with labels) rendered in the text format for /metrics.
+# updating a metric is a lock + dict lookup, everything that is already counted somewhere else
+# (cache stats, scheduler state, job table) is read by collectors only when /metrics gets scraped.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, math.inf), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+def register_collector(func):
+    """
+    Registers func() -> [(name, kind, help, [(labels dict, value), ...]), ...], called on every scrape.
+    """
+    _collectors.append(func)
+
+
+def render():
+    """
+    All metrics in the prometheus text format (version 0.0.4).
+    """
+    lines = []
+    for metric in list(_metrics):
+        samples = metric.render()
+        if samples:
+            lines += metric.header() + samples
+    # several collectors may report the same family (e.g. cache_hits_total), it may only appear once in the output
+    families = {}
+    for collector in list(_collectors):
+        try:
+            collected = collector()
+        except Exception as e:
+            print(f"[metrics] collector failed: {e}")
+            continue
+        for name, kind, help_text, samples in collected:
+            families.setdefault(name, (kind, help_text, []))[2].extend(samples)
+    for name, (kind, help_text, samples) in families.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def authorized(authorization, token):
+    """
+    Checks an Authorization header against the configured token (no token = everybody may scrape).
+    """
+    if not token:
+        return True
+    sent = (authorization or "").removeprefix("Bearer ").strip()
+    return hmac.compare_digest(sent.encode(), token.encode())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    token = ""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        if not authorized(self.headers.get("Authorization"), self.token):
+            self.send_error(401)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every 15s would drown the job logs
+        pass
+
+
+def serve(host, port, token=""):
+    """
+    Serves /metrics of this process on its own port, for processes without the flask app
+    (the job worker records most of the model/tts/video metrics).
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"token": token})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[metrics] serving http://{host}:{port}/metrics")
+    return server
+
+
+def cache_families(cache, hits, misses):
+    # the same three series for every cache, so dashboards can treat them alike
+    lookups = hits + misses
+    return [
+        ("cache_hits_total", "counter", "Cache hits", [({"cache": cache}, hits)]),
+        ("cache_misses_total", "counter", "Cache misses", [({"cache": cache}, misses)]),
+        ("cache_hit_ratio", "gauge", "Cache hits / lookups since start", [({"cache": cache}, hits / lookups if lookups else 0.0)]),
+    ]
+
+
+#----------------------- The metrics -----------------------#
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Time to build the response per route",
+                            ("route", "method", "status"))
+MODEL_LATENCY = Histogram("model_call_duration_seconds", "Duration of single model/tts calls (every attempt)",
+                          ("provider", "model", "outcome"))
+MODEL_TOKENS = Counter("model_tokens_total", "Tokens reported by the providers", ("provider", "model", "direction"))
+STAGE_LATENCY = Histogram("pipeline_stage_duration_seconds", "Wall time of pipeline stages (tts, whisper, encode, pdf render, ...)",
+                          ("stage",))
+VIDEO_SECONDS = Counter("video_seconds_produced_total", "Seconds of video rendered")
+VIDEO_RENDER_SECONDS = Counter("video_render_seconds_total", "Wall seconds spent rendering videos")
+VIDEO_REALTIME = Gauge("video_seconds_per_wall_second", "Video seconds produced per wall second, last render")
+
+
+def _on_stage(name, wall, cpu, peak_rss):
+    STAGE_LATENCY.observe(wall, stage=name)
+
+
+perf.add_listener(_on_stage)
+
+
+def record_video(video_seconds, wall_seconds):
+    VIDEO_SECONDS.inc(video_seconds)
+    VIDEO_RENDER_SECONDS.inc(wall_seconds)
+    if wall_seconds > 0:
+        VIDEO_REALTIME.set(video_seconds / wall_seconds)
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# stage timings for the pipelines (tts, encode, pdf render, model calls, ...).
+# stage() costs a clock read and an os.times() call, so it is fine to leave it in the hot paths.
+# whoever wants the numbers registers a listener (the benchmark, the metrics endpoint).
+
+_listeners = []
+
+# rss sampling only runs while somebody asked for it (it needs a thread)
+RSS_SAMPLE_INTERVAL = 0.02
+_rss_lock = threading.Lock()
+_rss_users = 0
+_rss_active = {}      # id of a running stage -> peak rss seen so far
+_rss_thread = None
+
+
+def add_listener(func):
+    """
+    Registers func(name, wall_seconds, cpu_seconds, peak_rss_bytes) to be called after every stage.
+    peak_rss_bytes is None unless rss sampling is on.
+    """
+    _listeners.append(func)
+
+
+def remove_listener(func):
+    if func in _listeners:
+        _listeners.remove(func)
+
+
+def enabled():
+    return bool(_listeners)
+
+
+def record(name, wall, cpu, peak_rss=None):
+    """
+    Reports a stage that was measured by hand (e.g. time spread over many small calls).
+    """
+    for listener in list(_listeners):
+        try:
+            listener(name, wall, cpu, peak_rss)
+        except Exception as e:
+            print(f"[perf] listener failed for {name}: {e}")
+
+
+def cpu_seconds():
+    # this process plus the children it waited for (ffmpeg, encode workers)
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        # linux reports KB, no /proc probably means macos which reports bytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _sample_rss():
+    while True:
+        with _rss_lock:
+            if not _rss_users:
+                global _rss_thread
+                _rss_thread = None
+                return
+            rss = current_rss()
+            for key, peak in _rss_active.items():
+                if rss > peak:
+                    _rss_active[key] = rss
+        time.sleep(RSS_SAMPLE_INTERVAL)
+
+
+def start_rss_sampling():
+    """
+    Turns on peak rss tracking for stages (counted, every start needs a stop).
+    """
+    global _rss_users, _rss_thread
+    with _rss_lock:
+        _rss_users += 1
+        if _rss_thread is None:
+            _rss_thread = threading.Thread(target=_sample_rss, name="rss-sampler", daemon=True)
+            _rss_thread.start()
+
+
+def stop_rss_sampling():
+    global _rss_users
+    with _rss_lock:
+        _rss_users = max(0, _rss_users - 1)
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures the block as pipeline stage `name` (e.g. "video.tts") and reports it to the listeners.
+    Stages can nest and run on several threads at once, cpu time is process wide though.
+    """
+    if not _listeners:
+        yield
+        return
+
+    key = object()
+    sampling = _rss_users > 0
+    if sampling:
+        with _rss_lock:
+            _rss_active[key] = current_rss()
+    wall_start = time.perf_counter()
+    cpu_start = cpu_seconds()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = cpu_seconds() - cpu_start
+        peak = None
+        if sampling:
+            with _rss_lock:
+                peak = max(_rss_active.pop(key), current_rss())
+        record(name, wall, cpu, peak)
@@ -0,0 +1,23 @@
+import fitz
+
+# PDF page rasterization for the render pool. The pool's processes import this module, so it only
+# needs fitz: no model clients, no config, nothing that runs at import time.
+
+
+def render_pages(file_path, page_numbers, dpi, fmt, quality):
+    """
+    Renders the given (0-based) pages of a PDF.
+
+    Returns:
+        list: Image bytes (jpeg or png) in the order of page_numbers.
+    """
+    # every worker opens the document itself
+    images = []
+    doc = fitz.open(file_path)
+    try:
+        for page_num in page_numbers:
+            pix = doc.load_page(page_num).get_pixmap(dpi=dpi)
+            images.append(pix.tobytes("jpeg", jpg_quality=quality) if fmt == "jpeg" else pix.tobytes("png"))
+    finally:
+        doc.close()
+    return images
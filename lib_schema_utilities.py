@@ -0,0 +1,212 @@
+import json
+import re
+
+# Schemas for the structured stuff we ask gemini for. They use the OpenAPI subset gemini understands
+# for generationConfig.responseSchema, and validate() checks answers against the same dicts locally
+# (the model follows them most of the time, "most" being the problem).
+
+PLAN_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "chapters": {
+            "type": "ARRAY",
+            "minItems": 1,
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "title": {"type": "STRING"},
+                    "summary": {"type": "STRING"},
+                    "subtopics": {
+                        "type": "ARRAY",
+                        "minItems": 1,
+                        "items": {
+                            "type": "OBJECT",
+                            "properties": {
+                                "title": {"type": "STRING"},
+                                "description": {"type": "STRING"}
+                            },
+                            "required": ["title", "description"]
+                        }
+                    }
+                },
+                "required": ["title", "summary", "subtopics"]
+            }
+        }
+    },
+    "required": ["chapters"]
+}
+
+QUESTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "question": {"type": "STRING"},
+        "options": {"type": "ARRAY", "items": {"type": "STRING"}, "minItems": 4, "maxItems": 4},
+        "answer": {"type": "STRING"}
+    },
+    "required": ["question", "options", "answer"]
+}
+
+QUIZ_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "questions": {"type": "ARRAY", "minItems": 1, "items": QUESTION_SCHEMA}
+    },
+    "required": ["questions"]
+}
+
+CHAPTER_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "subtopics": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "index": {"type": "INTEGER"},
+                    "notes": {"type": "STRING"},
+                    "quiz": QUIZ_SCHEMA
+                },
+                "required": ["index", "notes", "quiz"]
+            }
+        }
+    },
+    "required": ["subtopics"]
+}
+
+_TYPES = {
+    "OBJECT": dict,
+    "ARRAY": list,
+    "STRING": str,
+    "INTEGER": int,
+    "NUMBER": (int, float),
+    "BOOLEAN": bool
+}
+
+
+def validate(data, schema, path="$"):
+    """
+    Checks data against one of the schemas above.
+
+    Returns:
+        list: Human readable problems (empty if the data is fine), e.g. "$.questions[3].options: expected 4 items".
+    """
+    expected = schema.get("type", "").upper()
+    python_type = _TYPES.get(expected)
+    # bool is an int in python, dont let True pass as a number
+    if python_type and (not isinstance(data, python_type) or (expected in ("INTEGER", "NUMBER") and isinstance(data, bool))):
+        return [f"{path}: expected {expected.lower()}"]
+
+    errors = []
+    if expected == "OBJECT":
+        for key in schema.get("required", []):
+            if key not in data:
+                errors.append(f"{path}.{key}: missing")
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in data:
+                errors += validate(data[key], sub_schema, f"{path}.{key}")
+    elif expected == "ARRAY":
+        if "minItems" in schema and len(data) < int(schema["minItems"]):
+            errors.append(f"{path}: expected at least {schema['minItems']} items")
+        if "maxItems" in schema and len(data) > int(schema["maxItems"]):
+            errors.append(f"{path}: expected at most {schema['maxItems']} items")
+        if "items" in schema:
+            for i, item in enumerate(data):
+                errors += validate(item, schema["items"], f"{path}[{i}]")
+    elif expected == "STRING" and not data.strip():
+        errors.append(f"{path}: empty")
+    return errors
+
+
+def parse_json(text):
+    """
+    json.loads that also takes the usual near-misses: ```json fences, chatter around the
+    json and trailing commas. Raises ValueError if there is nothing usable.
+    """
+    if not isinstance(text, str):
+        raise ValueError("expected text")
+    text = text.strip()
+    match = re.search(r"```(?:json)?\s*(.*?)\s*```", text, re.DOTALL)
+    if match:
+        text = match.group(1).strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    # cut away everything before the first and after the last bracket
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise ValueError("no json found in the answer")
+    start = min(starts)
+    end = text.rfind("}" if text[start] == "{" else "]")
+    candidate = text[start:end + 1]
+    # trailing commas (",}" / ",]") are the other classic
+    candidate = re.sub(r",\s*([}\]])", r"\1", candidate)
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid json: {e}") from e
+
+
+def repair_question(question):
+    """
+    Fixes the answers the model likes to give as a letter ("B"), a number or with different
+    casing/spacing than the option. Returns the question or None if it cant be saved.
+    """
+    if not isinstance(question, dict):
+        return None
+    options = question.get("options")
+    answer = question.get("answer")
+    if isinstance(options, list) and all(isinstance(o, str) for o in options):
+        options = [o.strip() for o in options]
+        if isinstance(answer, str):
+            answer = answer.strip()
+            if answer not in options:
+                by_text = {o.casefold(): o for o in options}
+                letter = re.fullmatch(r"\(?([A-Da-d])[).:]?", answer)
+                if answer.casefold() in by_text:
+                    answer = by_text[answer.casefold()]
+                elif letter and len(options) == 4:
+                    answer = options["abcd".index(letter.group(1).lower())]
+        elif isinstance(answer, int) and not isinstance(answer, bool) and 0 <= answer < len(options):
+            answer = options[answer]
+        question = {**question, "options": options, "answer": answer}
+    if validate(question, QUESTION_SCHEMA) or question["answer"] not in question["options"]:
+        return None
+    return question
+
+
+def repair_quiz(quiz_data):
+    """
+    Normalizes a quiz answer to {"questions": [...]} and keeps only the questions that are valid
+    (after repair_question). Returns (quiz, number of dropped questions).
+    """
+    if isinstance(quiz_data, list):
+        quiz_data = {"questions": quiz_data}
+    if not isinstance(quiz_data, dict):
+        return {"questions": []}, 0
+    # normalize ig
+    questions = quiz_data.get("questions", quiz_data.get("quiz"))
+    if not isinstance(questions, list):
+        return {"questions": []}, 0
+    repaired = [q for q in (repair_question(q) for q in questions) if q is not None]
+    return {"questions": repaired}, len(questions) - len(repaired)
+
+
+def repair_notes(notes, title):
+    """
+    Strips ```markdown fences and adds the "# title" heading if the model skipped it.
+    Returns the notes or None if they arent usable.
+    """
+    if not isinstance(notes, str):
+        return None
+    notes = notes.strip()
+    match = re.fullmatch(r"```(?:markdown|md)?\s*(.*?)\s*```", notes, re.DOTALL)
+    if match:
+        notes = match.group(1).strip()
+    # notes without a single "##" section are just chatter
+    if "##" not in notes:
+        return None
+    if not notes.startswith("#"):
+        notes = f"# {title}\n\n{notes}"
+    return notes
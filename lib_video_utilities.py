@@ -2,12 +2,24 @@ import asyncio
 import edge_tts
 import os
 from pydub import AudioSegment
-from moviepy.editor import VideoFileClip, AudioFileClip, CompositeVideoClip, TextClip
-import whisper
+from moviepy.editor import VideoFileClip, AudioFileClip, CompositeVideoClip
 import lib_ai_utilities as ai
+import lib_encode_utilities as encode
+from lib_encode_utilities import caption_cache, create_subtitle_clips, open_background
+import lib_perf_utilities as perf
+import lib_metrics_utilities as metrics
+from lib_disk_cache_utilities import DiskBudget
 import random
 import shutil
 import os
+import threading
+import time
+import hashlib
+import json
+import wave
+import subprocess
+import tempfile
+import imageio_ffmpeg
 
 # setup
 import tomllib
@@ -21,6 +33,85 @@ print(config["Api_keys"]["OpenAi"])   # your Open Ai API KEY
 
 google_ai_studio_key = config["Api_keys"]["Gemini"]
 
+video_config = config.get("Video", {})
+
+# edge-tts has no setting for its endpoint, swapping the url constant its websocket connects to is the only way
+# (used to run against emulator.py, empty = the real service)
+TTS_URL = config.get("Endpoints", {}).get("tts_url", "")
+if TTS_URL:
+    import edge_tts.communicate
+    edge_tts.communicate.WSS_URL = TTS_URL
+
+
+#----------------------- Whisper model manager -----------------------#
+# loading whisper medium takes seconds and GBs of ram, so we do it once per process and keep it around
+WHISPER_MODEL = video_config.get("whisper_model", "medium")
+WHISPER_IDLE_TIMEOUT = video_config.get("whisper_idle_timeout", 600)   # seconds, 0 = keep forever
+
+_whisper_models = {}        # name -> loaded model
+_whisper_locks = {}         # name -> lock, one transcription per model at a time (the decoder hooks arent thread safe)
+_whisper_last_used = {}     # name -> time.monotonic()
+_whisper_lock = threading.Lock()
+_whisper_reaper = None
+
+
+def _get_whisper_model(name):
+    global _whisper_reaper
+    with _whisper_lock:
+        if name not in _whisper_models:
+            # imported here, torch takes seconds and a lot of memory and most renders never need it
+            import whisper
+            print(f"Loading Whisper model '{name}'...")
+            _whisper_models[name] = whisper.load_model(name)
+            _whisper_locks[name] = threading.Lock()
+        _whisper_last_used[name] = time.monotonic()
+
+        if WHISPER_IDLE_TIMEOUT and _whisper_reaper is None:
+            _whisper_reaper = threading.Thread(target=_release_idle_whisper_models, name="whisper-reaper", daemon=True)
+            _whisper_reaper.start()
+        return _whisper_models[name], _whisper_locks[name]
+
+
+def _release_idle_whisper_models():
+    while True:
+        time.sleep(min(60, WHISPER_IDLE_TIMEOUT))
+        with _whisper_lock:
+            for name in list(_whisper_models):
+                idle = time.monotonic() - _whisper_last_used[name]
+                # skip models that are transcribing right now
+                if idle > WHISPER_IDLE_TIMEOUT and not _whisper_locks[name].locked():
+                    print(f"Releasing idle Whisper model '{name}'")
+                    del _whisper_models[name]
+                    del _whisper_locks[name]
+                    del _whisper_last_used[name]
+
+
+def prewarm_whisper(names=None):
+    """
+    Loads the configured Whisper model(s) up front so the first video doesnt pay for it.
+    """
+    for name in names or [WHISPER_MODEL]:
+        _get_whisper_model(name)
+
+
+def transcribe(audio_path, model_name=None):
+    """
+    Transcribes an audio file with a shared, already loaded Whisper model.
+
+    Args:
+        audio_path (str): Path to the audio file.
+        model_name (str): Whisper model to use, defaults to the one in config.toml.
+
+    Returns:
+        dict: The whisper result (with "segments").
+    """
+    name = model_name or WHISPER_MODEL
+    model, lock = _get_whisper_model(name)
+    with lock:
+        result = model.transcribe(audio_path)
+    _whisper_last_used[name] = time.monotonic()
+    return result
+
 
 def make_video(title, description, analysis, output_path):
     print("generating video...")
@@ -70,14 +161,301 @@ def make_video(title, description, analysis, output_path):
 
 
             # prompt gemini for podcast
-            Script = ai.prompt_chat_gpt("gpt-3.5-turbo", Prompt)
+            with perf.stage("video.script"):
+                Script = ai.prompt_chat_gpt("gpt-3.5-turbo", Prompt)
             print("\n\n\n Script: \n" + Script + "\n\n\n")
 
             # generate the podcast
             generate_podcast_video(Script, output_path, "mc")
     
 
+#----------------------- TTS cache -----------------------#
+# synthesized clips are stored by (voice, normalized text, settings) so retries and re-renders skip edge-tts
+TTS_CACHE_DIR = video_config.get("tts_cache_dir", "tts_cache")
+TTS_CACHE_MAX_MB = video_config.get("tts_cache_max_mb", 500)
+TTS_SETTINGS = {"boundary": "WordBoundary", "format": "mp3"}   # bump this if the way we call edge-tts changes
+
+tts_cache_stats = {"hits": 0, "misses": 0}
+_tts_cache_lock = threading.Lock()
+_tts_cache_budget = DiskBudget(TTS_CACHE_DIR, TTS_CACHE_MAX_MB * 1024 * 1024, name="tts-cache")
+
+
+def _collect_metrics():
+    with _tts_cache_lock:
+        stats = dict(tts_cache_stats)
+    with caption_cache.lock:
+        caption_hits, caption_misses = caption_cache.hits, caption_cache.misses
+    return (metrics.cache_families("tts", stats["hits"], stats["misses"])
+            + metrics.cache_families("caption", caption_hits, caption_misses))
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def normalize_tts_text(text):
+    return " ".join(text.split())
+
+
+def _tts_cache_path(voice, text):
+    key_parts = [voice, normalize_tts_text(text), TTS_SETTINGS]
+    # clips from another endpoint (the emulator's silent ones) must not end up in real videos
+    if TTS_URL:
+        key_parts.append(TTS_URL)
+    raw = json.dumps(key_parts, sort_keys=True, ensure_ascii=False)
+    key = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    return os.path.join(TTS_CACHE_DIR, key[:2], key)
+
+
+def tts_cache_get(voice, text, output_filename):
+    """
+    Copies a cached clip to output_filename and returns its word timings, or None on a miss.
+    """
+    path = _tts_cache_path(voice, text)
+    try:
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            words = [tuple(word) for word in json.load(f)]
+        shutil.copyfile(path + ".mp3", output_filename)
+        _tts_cache_budget.touch(path + ".mp3")   # mtime doubles as "last used" for the LRU eviction
+    except (OSError, ValueError):
+        with _tts_cache_lock:
+            tts_cache_stats["misses"] += 1
+        return None
+    with _tts_cache_lock:
+        tts_cache_stats["hits"] += 1
+    return words
+
+
+def tts_cache_put(voice, text, audio_path, words):
+    path = _tts_cache_path(voice, text)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to temp files first so a crashed render never leaves half a clip in the cache
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.copyfile(audio_path, tmp)
+    os.replace(tmp, path + ".mp3")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(words, f, ensure_ascii=False)
+    os.replace(tmp, path + ".json")
+    # running byte count, the folder only gets scanned (on a background thread) once it is over the limit
+    _tts_cache_budget.added(os.path.getsize(path + ".mp3") + os.path.getsize(path + ".json"))
+
+
+#----------------------- Audio assembly -----------------------#
+AUDIO_GAP_MS = video_config.get("audio_gap_ms", 0)   # silence between two lines
+
+
+def assemble_audio(audio_files, output_path, gap_ms=None):
+    """
+    Decodes the per-line clips one after another and streams their PCM straight into one wav file,
+    so assembly is linear in podcast length and only one clip is in memory at a time
+    (AudioSegment += copies the whole track every time).
+
+    Args:
+        audio_files (list): Clip paths named "<line index>.mp3", in script order.
+        output_path (str): Where the combined wav goes.
+        gap_ms (int): Silence between lines, defaults to audio_gap_ms from config.toml.
+
+    Returns:
+        dict: line index -> start of that line in the combined audio (seconds).
+    """
+    gap_ms = AUDIO_GAP_MS if gap_ms is None else gap_ms
+    offsets = {}
+    frames_written = 0
+
+    with wave.open(output_path, "wb") as out:
+        fmt = None
+        for n, file in enumerate(audio_files):
+            clip = AudioSegment.from_mp3(file)
+            if fmt is None:
+                # the first clip decides the format of the whole track
+                fmt = (clip.channels, clip.sample_width, clip.frame_rate)
+                out.setnchannels(clip.channels)
+                out.setsampwidth(clip.sample_width)
+                out.setframerate(clip.frame_rate)
+                frame_width = clip.channels * clip.sample_width
+                silence = (b"\x80" if clip.sample_width == 1 else b"\x00") * frame_width
+                gap_frames = int(clip.frame_rate * gap_ms / 1000)
+            elif (clip.channels, clip.sample_width, clip.frame_rate) != fmt:
+                clip = clip.set_channels(fmt[0]).set_sample_width(fmt[1]).set_frame_rate(fmt[2])
+
+            if n and gap_frames:
+                out.writeframes(silence * gap_frames)
+                frames_written += gap_frames
+
+            index = int(os.path.splitext(os.path.basename(file))[0])
+            offsets[index] = frames_written / fmt[2]
+            out.writeframes(clip.raw_data)
+            frames_written += len(clip.raw_data) // frame_width
+
+    return offsets
+
+
+#----------------------- Background videos -----------------------#
+# every stock video gets transcoded once into a proxy at output size/fps with a keyframe every second,
+# so renders dont decode the full size original again and seeking into any segment is cheap
+STOCK_VIDEO_DIR = "stock_videos"
+PROXY_DIR = video_config.get("proxy_dir", os.path.join(STOCK_VIDEO_DIR, "proxies"))
+VIDEO_WIDTH = video_config.get("video_width", 0)      # 0 = keep the size of the stock video
+VIDEO_HEIGHT = video_config.get("video_height", 0)
+VIDEO_FPS = video_config.get("video_fps", 30)
+
+_proxy_lock = threading.Lock()
+
+
+def get_background_proxy(name, width=None, height=None, fps=None):
+    """
+    Returns the path of the proxy for stock_videos/<name>.mp4, building it first if needed.
+    The proxy name contains a hash of the source size/mtime, so changing the source builds a new one.
+    """
+    width = VIDEO_WIDTH if width is None else width
+    height = VIDEO_HEIGHT if height is None else height
+    fps = fps or VIDEO_FPS
+
+    source = os.path.join(STOCK_VIDEO_DIR, f"{name}.mp4")
+    st = os.stat(source)
+    fingerprint = hashlib.sha256(f"{os.path.abspath(source)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:12]
+    prefix = f"{name}_{width}x{height}_{fps}fps_"
+    proxy = os.path.join(PROXY_DIR, f"{prefix}{fingerprint}.mp4")
+
+    with _proxy_lock:
+        if os.path.isfile(proxy):
+            return proxy
+
+        os.makedirs(PROXY_DIR, exist_ok=True)
+        print(f"Building background proxy {proxy}...")
+        filters = [f"fps={fps}"]
+        if width and height:
+            filters.append(f"scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height}")
+        tmp = f"{proxy}.{os.getpid()}.tmp.mp4"
+        subprocess.run([
+            imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-i", source,
+            "-vf", ",".join(filters),
+            "-an",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p",
+            "-g", str(fps), "-keyint_min", str(fps), "-sc_threshold", "0",
+            tmp
+        ], check=True)
+        os.replace(tmp, proxy)
+
+        # old proxies of the same video/settings are stale now
+        # (finished ones only, a .tmp.mp4 is another process building its proxy right now)
+        for file in os.listdir(PROXY_DIR):
+            if file.startswith(prefix) and not file.endswith(".tmp.mp4") and os.path.join(PROXY_DIR, file) != proxy:
+                try:
+                    os.remove(os.path.join(PROXY_DIR, file))
+                except FileNotFoundError:
+                    pass
+    return proxy
+
+
+#----------------------- Subtitles -----------------------#
+# "tts" builds the subtitles from the edge-tts word boundaries (no extra work),
+# "whisper" transcribes the finished audio again (slow, but works for any audio)
+SUBTITLE_MODE = video_config.get("subtitle_mode", "tts")
+SUBTITLE_MAX_WORDS = 5
+
+
+def format_time(t):
+    h = int(t // 3600)
+    m = int((t % 3600) // 60)
+    s = int(t % 60)
+    ms = int((t - int(t)) * 1000)
+    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+
+
+def split_text(text, max_words=SUBTITLE_MAX_WORDS):
+    words = text.split()
+    return [" ".join(words[i:i+max_words]) for i in range(0, len(words), max_words)]
+
+
+def subtitle_segments_from_words(line_words, line_offsets, max_words=SUBTITLE_MAX_WORDS):
+    """
+    Turns per-line word timings into (start, end, text) subtitle chunks on the combined audio timeline.
+
+    Args:
+        line_words (dict): line index -> [(start, end, word)] relative to that line's clip.
+        line_offsets (dict): line index -> start of that line's clip in the combined audio (seconds).
+        max_words (int): Words per subtitle chunk.
+    """
+    segments = []
+    for i in sorted(line_offsets):
+        offset = line_offsets[i]
+        words = line_words.get(i, [])
+        chunks = [words[j:j+max_words] for j in range(0, len(words), max_words)]
+        for j, chunk in enumerate(chunks):
+            start = offset + chunk[0][0]
+            end = offset + chunk[-1][1]
+            # keep the caption up until the next chunk of the same line starts
+            if j + 1 < len(chunks):
+                end = max(end, offset + chunks[j + 1][0][0])
+            segments.append((start, end, " ".join(word for _, _, word in chunk)))
+    return segments
+
+
+def subtitle_segments_from_whisper(result, max_words=SUBTITLE_MAX_WORDS):
+    """
+    Splits whisper segments into (start, end, text) chunks, spreading the time evenly over the chunks.
+    """
+    segments = []
+    for segment in result["segments"]:
+        start = segment["start"]
+        end = segment["end"]
+        text = segment["text"].strip()
+
+        chunks = split_text(text, max_words=max_words)
+        duration_per_chunk = (end - start) / len(chunks) if len(chunks) > 0 else end - start
+
+        for j, chunk in enumerate(chunks):
+            chunk_start = start + j * duration_per_chunk
+            chunk_end = chunk_start + duration_per_chunk
+            segments.append((chunk_start, chunk_end, chunk))
+    return segments
+
+
+#----------------------- Scratch workspaces -----------------------#
+# every render gets its own folder for clips, the combined track and the subtitles,
+# so several renders can run side by side (point scratch_dir at /dev/shm for tmpfs)
+SCRATCH_DIR = video_config.get("scratch_dir", "") or None     # empty = system temp folder
+
+
 def generate_podcast_video(Script, output_path, background_video):
+    """
+    Renders a podcast video in its own scratch workspace. The workspace is deleted when the
+    render worked and kept around when it failed, so you can look at what went wrong.
+    """
+    if SCRATCH_DIR:
+        os.makedirs(SCRATCH_DIR, exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix="render_", dir=SCRATCH_DIR)
+    started = time.perf_counter()
+    try:
+        duration = render_podcast_video(Script, output_path, background_video, workspace)
+    except Exception:
+        print(f"❌ Render failed, scratch workspace kept for debugging: {workspace}")
+        raise
+    metrics.record_video(duration, time.perf_counter() - started)
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+def _time_frames(clip):
+    # wraps the clip's make_frame and adds up the time spent in it
+    totals = {"wall": 0.0, "cpu": 0.0}
+    make_frame = clip.make_frame
+
+    def timed(t):
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        frame = make_frame(t)
+        totals["wall"] += time.perf_counter() - wall_start
+        totals["cpu"] += time.thread_time() - cpu_start
+        return frame
+
+    clip.make_frame = timed
+    return totals
+
+
+def render_podcast_video(Script, output_path, background_video, workspace):
+    """
+    Returns the length of the rendered video in seconds.
+    """
     #------------------------- Ask the user to upload a file ---------------#
 
     TEXT = Script
@@ -88,116 +466,130 @@ def generate_podcast_video(Script, output_path, background_video):
 
     #----------------------- TTS Setup -----------------------#
     VOICES = ['de-DE-AmalaNeural', 'de-DE-ConradNeural']
-    OUTPUT_PATH = "audios/"
-    # delete previous audios
-    shutil.rmtree(OUTPUT_PATH)
+    OUTPUT_PATH = os.path.join(workspace, "audios")
     os.makedirs(OUTPUT_PATH, exist_ok=True)
 
+    # line index -> [(start, end, word)] relative to the start of that line's clip
+    line_words = {}
+
     async def tts(text, output_filename, VOICE):
-        communicate = edge_tts.Communicate(text, voice=VOICES[VOICE])
-        await communicate.save(output_filename)
+        communicate = edge_tts.Communicate(text, voice=VOICES[VOICE], boundary="WordBoundary")
+        words = []
+        with open(output_filename, "wb") as f:
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    f.write(chunk["data"])
+                elif chunk["type"] == "WordBoundary":
+                    # edge-tts offsets are in 100ns ticks
+                    start = chunk["offset"] / 10_000_000
+                    end = start + chunk["duration"] / 10_000_000
+                    words.append((start, end, chunk["text"]))
+        return words
+
+    async def synthesize_line(i, line):
+        audio_name = f"{i}.mp3"
+        if line.startswith('Tom:'):
+            line = line[len('Tom: '):]
+            VOICE = 1
+        elif line.startswith('Lisa:'):
+            line = line[len('Lisa: '):]
+            VOICE = 0
+        else:
+            return
+        line = normalize_tts_text(line)
+
+        # already synthesized this exact line with this voice before? then no network needed
+        cached = await asyncio.to_thread(tts_cache_get, VOICES[VOICE], line, os.path.join(OUTPUT_PATH, audio_name))
+        if cached is not None:
+            line_words[i] = cached
+            print(f"Cached audio for line {i}: {line[:30]}...")
+            return
+
+        # rate limit, concurrency and retries come from the shared "edge-tts" limiter ([Scheduler.edge-tts]),
+        # so parallel renders share one quota. edge-tts errors carry no status codes, every failure is worth a retry
+        try:
+            with perf.stage("video.tts_clip"):
+                line_words[i] = await ai.scheduled("edge-tts", lambda: tts(line, os.path.join(OUTPUT_PATH, audio_name), VOICE),
+                                                   retry_on=lambda e: True, model=VOICES[VOICE])
+        except Exception as e:
+            raise RuntimeError(f"TTS failed for line {i}: {e}") from e
+        await asyncio.to_thread(tts_cache_put, VOICES[VOICE], line, os.path.join(OUTPUT_PATH, audio_name), line_words[i])
+        print(f"Generated audio for line {i}: {line[:30]}...")
 
     async def process_script(SCRIPT, OUTPUT_PATH):
-        for i, line in enumerate(SCRIPT):
-            audio_name = f"{i}.mp3"
-            if line.startswith('Tom:'):
-                line = line[len('Tom: '):]
-                await tts(line, os.path.join(OUTPUT_PATH, audio_name), 1)
-            elif line.startswith('Lisa:'):
-                line = line[len('Lisa: '):]
-                await tts(line, os.path.join(OUTPUT_PATH, audio_name), 0)
-            
-            print(f"Generated audio for line {i}: {line[:30]}...")
-            await asyncio.sleep(1.5)  # small delay between requests
-
-    asyncio.run(process_script(SCRIPT, OUTPUT_PATH))
+        # lines are synthesized concurrently, the file names keep them in script order
+        await asyncio.gather(*(synthesize_line(i, line) for i, line in enumerate(SCRIPT)))
+
+    with perf.stage("video.tts"):
+        asyncio.run(process_script(SCRIPT, OUTPUT_PATH))
+    print(f"TTS cache: {tts_cache_stats['hits']} hits, {tts_cache_stats['misses']} misses")
 
     #----------------- Combine audio files -----------------#
     audio_files = sorted([os.path.join(OUTPUT_PATH, f) for f in os.listdir(OUTPUT_PATH) if f.endswith(".mp3")],
                         key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
 
-    combined = AudioSegment.from_mp3(audio_files[0])
-    for file in audio_files[1:]:
-        combined += AudioSegment.from_mp3(file)
-
-    combined_audio_path = "audios/full_audio.wav"
-    combined.export(combined_audio_path, format="wav")
+    # line_offsets = where every line starts in the combined track so we can shift the word timings
+    combined_audio_path = os.path.join(workspace, "full_audio.wav")
+    with perf.stage("video.audio_concat"):
+        line_offsets = assemble_audio(audio_files, combined_audio_path)
     print("✅ Audio combined:", combined_audio_path)
 
-    #----------------- Video background -----------------#
-    Background = background_video
-
-    video = VideoFileClip(f'stock_videos/{Background}.mp4')
-    audio = AudioFileClip(combined_audio_path)
-    video = video.set_audio(audio).subclip(0, audio.duration)
-
-    #----------------- Whisper transcription -----------------#
-    print("Transcribing audio with Whisper...")
-    model = whisper.load_model("medium")
-    result = model.transcribe(combined_audio_path)
-
-    #----------------- Generate SRT and subtitle segments -----------------#
-    def format_time(t):
-        h = int(t // 3600)
-        m = int((t % 3600) // 60)
-        s = int(t % 60)
-        ms = int((t - int(t)) * 1000)
-        return f"{h:02}:{m:02}:{s:02},{ms:03}"
-
+    #----------------- Subtitle segments -----------------#
+    subtitle_mode = SUBTITLE_MODE
+    if subtitle_mode == "tts" and not all(line_words.get(i) for i in line_offsets):
+        # edge-tts didnt send word boundaries for some line, whisper it is
+        print("Missing word boundaries from edge-tts, falling back to Whisper")
+        subtitle_mode = "whisper"
+
+    if subtitle_mode == "tts":
+        with perf.stage("video.subtitles"):
+            subtitle_segments = subtitle_segments_from_words(line_words, line_offsets)
+    else:
+        print("Transcribing audio with Whisper...")
+        with perf.stage("video.whisper"):
+            result = transcribe(combined_audio_path)
+        subtitle_segments = subtitle_segments_from_whisper(result)
+
+    #----------------- Generate SRT -----------------#
     subtitles = []
-    subtitle_segments = []
+    for start, end, chunk in subtitle_segments:
+        subtitles.append(f"{len(subtitles)+1}\n{format_time(start)} --> {format_time(end)}\n{chunk}\n")
 
-    def split_text(text, max_words=5):
-        words = text.split()
-        return [" ".join(words[i:i+max_words]) for i in range(0, len(words), max_words)]
-
-    for i, segment in enumerate(result["segments"]):
-        start = segment["start"]
-        end = segment["end"]
-        text = segment["text"].strip()
-        
-        chunks = split_text(text, max_words=5)
-        duration_per_chunk = (end - start) / len(chunks) if len(chunks) > 0 else end - start
-        
-        for j, chunk in enumerate(chunks):
-            chunk_start = start + j * duration_per_chunk
-            chunk_end = chunk_start + duration_per_chunk
-            subtitle_segments.append((chunk_start, chunk_end, chunk))
-            
-            start_str = format_time(chunk_start)
-            end_str = format_time(chunk_end)
-            subtitles.append(f"{len(subtitles)+1}\n{start_str} --> {end_str}\n{chunk}\n")
-
-    srt_path = "subtitles.srt"
+    srt_path = os.path.join(workspace, "subtitles.srt")
     with open(srt_path, "w", encoding="utf-8") as f:
         f.writelines(subtitles)
     print("✅ Subtitles saved:", srt_path)
 
-    #----------------- Overlay subtitles on video -----------------#
-    def create_subtitle_clips(srt_file, video_width):
-        clips = []
-        for start_time, end_time, txt in subtitle_segments:
-            clip = (
-                TextClip(
-                    txt,
-                    fontsize=80,
-                    color='white',
-                    font='Arial-Bold',
-                    stroke_color='red',
-                    stroke_width=4,
-                    size=(video_width * 0.8, None),  # wrap text to 80% of video width
-                    method='caption'                # pygame
-                )
-                .set_position(('center', 'center'))
-                .set_start(start_time)
-                .set_end(end_time)
-            )
-            clips.append(clip)
-        return clips
-
-    subtitle_clips = create_subtitle_clips(srt_path, video.w)
-    final_video = CompositeVideoClip([video, *subtitle_clips])
-    final_video.write_videofile(output_path, codec="libx264")
+    #----------------- Video background + subtitles -----------------#
+    Background = background_video
+    with perf.stage("video.background"):
+        background_path = get_background_proxy(Background)
+
+    with wave.open(combined_audio_path, "rb") as w:
+        duration = w.getnframes() / w.getframerate()
+
+    if encode.ENCODE_WORKERS != 1:
+        # cut at line starts so no segment boundary lands in the middle of a sentence
+        with perf.stage("video.encode"):
+            encode.encode_video_parallel(background_path, combined_audio_path, duration, subtitle_segments,
+                                  line_offsets.values(), output_path, os.path.join(workspace, "segments"))
+    else:
+        audio = AudioFileClip(combined_audio_path)
+        video = open_background(background_path, 0, audio.duration).set_audio(audio)
+
+        with perf.stage("video.subtitle_clips"):
+            subtitle_clips = create_subtitle_clips(subtitle_segments, video.w)
+        print(f"Captions: {caption_cache.summary()}")
+        final_video = CompositeVideoClip([video, *subtitle_clips])
+        # moviepy composites the frames while it encodes, time them separately so the two show up as stages
+        composite_time = _time_frames(final_video) if perf.enabled() else None
+        wall_start, cpu_start = time.perf_counter(), perf.cpu_seconds()
+        # moviepy puts its temp audio file into the cwd by default, which two renders would fight over
+        final_video.write_videofile(output_path, codec="libx264",
+                                    temp_audiofile=os.path.join(workspace, "temp_audio.m4a"))
+        if composite_time:
+            wall, cpu = time.perf_counter() - wall_start, perf.cpu_seconds() - cpu_start
+            perf.record("video.compositing", composite_time["wall"], composite_time["cpu"])
+            perf.record("video.encode", wall - composite_time["wall"], cpu - composite_time["cpu"])
     print(f"✅ Video with subtitles saved to {output_path}")
-
-
+    return duration
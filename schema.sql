@@ -1,6 +1,7 @@
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS projects;
 DROP TABLE IF EXISTS documents;
+DROP TABLE IF EXISTS jobs;
 
 CREATE TABLE users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -30,3 +31,24 @@ BEGIN
     DELETE FROM documents
     WHERE filename = NEW.filename;
 END;
+
+CREATE TABLE jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    result_url TEXT,
+    error TEXT,
+    attempts INTEGER DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    owner TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
+CREATE INDEX jobs_status_queue ON jobs (status, queue, id);
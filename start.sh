@@ -1,2 +1,6 @@
 source venv/bin/activate
+# background jobs (videos, notes, quizzes) run in their own process, see the "worker" command in app.py
+flask --app app worker &
+WORKER_PID=$!
+trap "kill $WORKER_PID" EXIT
 flask run